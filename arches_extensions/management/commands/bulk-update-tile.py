@@ -1,17 +1,236 @@
+import re
+import csv
+import json
+import time
 import uuid
+from collections import Counter
+from contextlib import nullcontext
 
+from django.db import connection, transaction
+from django.db.models import Q
 from django.core.management.base import BaseCommand
 
-from arches_extensions.utils import user_confirms
+from arches_extensions.managers import ResourceIndexManager
+from arches_extensions.utils import (
+    ArchesHelpTextFormatter,
+    get_graph,
+    get_uuid_ranges,
+    run_in_processes,
+    user_confirms,
+)
 from arches.app.models.models import Node
 from arches.app.models.tile import Tile
 
+_UNSET = object()
+
+class ValueMapper():
+    """
+    Computes the new value for a node from its current value.
+
+    A mapper either assigns one `constant` value to every tile, or remaps
+    values with an in-memory lookup table of old --> new `values`, a table
+    of per-resource values keyed by resourceinstanceid (`resources`), and a
+    list of `(pattern, replacement)` regex `rules`. Lookups win over rules,
+    and rules are applied in order to any string value that was not looked
+    up. List values (e.g. concept-list) are mapped item by item, and
+    localized string values are mapped per language.
+    """
+
+    def __init__(self, constant=_UNSET, values=None, resources=None, rules=None):
+        self.constant = constant
+        self.values = values or {}
+        self.resources = resources or {}
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules or []]
+
+    @classmethod
+    def from_csv(cls, path, rules=None):
+        """
+        Loads a map file. The CSV must have a `new_value` column and either
+        an `old_value` or a `resourceinstanceid` column (or both, in which
+        case each row uses whichever is filled in). Empty `new_value` cells
+        map to null.
+        """
+
+        values, resources = {}, {}
+        with open(path, newline="") as f:
+            reader = csv.DictReader(f)
+            fieldnames = reader.fieldnames or []
+            if "new_value" not in fieldnames or not {"old_value", "resourceinstanceid"}.intersection(fieldnames):
+                raise ValueError(f"invalid map file header: {reader.fieldnames}")
+            for row in reader:
+                new_value = row["new_value"] if row["new_value"] != "" else None
+                if row.get("resourceinstanceid"):
+                    resources[str(uuid.UUID(row["resourceinstanceid"]))] = new_value
+                else:
+                    values[row["old_value"]] = new_value
+        return cls(values=values, resources=resources, rules=rules)
+
+    @property
+    def is_constant(self):
+        return self.constant is not _UNSET
+
+    def map_value(self, value, resourceinstanceid=None):
+
+        if self.is_constant:
+            return self.constant
+        if resourceinstanceid is not None and str(resourceinstanceid) in self.resources:
+            return self.resources[str(resourceinstanceid)]
+        return self._map(value)
+
+    def _map(self, value):
+
+        if isinstance(value, list):
+            return [self._map(i) for i in value]
+        # localized strings look like {"en": {"value": "...", "direction": "ltr"}}
+        if isinstance(value, dict):
+            return {k: {**v, "value": self._map(v["value"])} if isinstance(v, dict) and "value" in v else v
+                    for k, v in value.items()}
+        if isinstance(value, str):
+            if value in self.values:
+                return self.values[value]
+            for pattern, replacement in self.rules:
+                value = pattern.sub(replacement, value)
+        return value
+
+def update_tile_chunks(tiles, nodeid, mapper, batch_size=1000, on_chunk=None, stop_event=None,
+                       collect_resourceids=False):
+    """
+    Writes new values for `nodeid` to every tile of the `tiles` queryset,
+    one chunk of tiles (and one transaction) at a time. The chunks are
+    walked in tileid order (keyset pagination), so the full list of tile
+    ids is never held in memory.
+
+    A constant `mapper` value is written with a single `jsonb_set` UPDATE
+    per chunk. Otherwise, the chunk's current values are read and locked,
+    mapped in Python, and only the changed values are written back in one
+    UPDATE joined against the new values.
+
+    `on_chunk` is called after each chunk is committed with the number of
+    tiles scanned, the number updated, and the set of resourceinstanceids
+    whose tiles were updated in the chunk (always empty unless
+    `collect_resourceids` is set). The loop stops before the next chunk
+    once `stop_event` is set. Returns the total number of tiles updated.
+    """
+
+    tiles = tiles.order_by("tileid")
+    value_key = f"data__{nodeid}"
+    total = 0
+    last_tileid = None
+    while stop_event is None or not stop_event.is_set():
+        batch = tiles if last_tileid is None else tiles.filter(tileid__gt=last_tileid)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                if mapper.is_constant:
+                    batch_sql, batch_params = batch.values("tileid")[:batch_size].query.sql_with_params()
+                    cursor.execute(f"""
+                        UPDATE tiles
+                        SET tiledata = jsonb_set(COALESCE(tiledata, '{{}}'::jsonb), %s::text[], %s::jsonb, true)
+                        WHERE tileid IN ({batch_sql})
+                        RETURNING tileid, resourceinstanceid
+                    """, [[nodeid], json.dumps(mapper.constant), *batch_params])
+                    returned = cursor.fetchall()
+                    scanned = [row[0] for row in returned]
+                    resourceids = {row[1] for row in returned} if collect_resourceids else set()
+                    updated = len(scanned)
+                else:
+                    rows = list(batch.select_for_update()
+                        .values_list("tileid", "resourceinstance_id", value_key)[:batch_size])
+                    scanned = [row[0] for row in rows]
+                    changes, resourceids = {}, set()
+                    for tileid, resourceinstanceid, old_value in rows:
+                        new_value = mapper.map_value(old_value, resourceinstanceid)
+                        if new_value != old_value:
+                            changes[tileid] = json.dumps(new_value)
+                            if collect_resourceids:
+                                resourceids.add(resourceinstanceid)
+                    if changes:
+                        cursor.execute("""
+                            UPDATE tiles
+                            SET tiledata = jsonb_set(COALESCE(tiledata, '{}'::jsonb), %s::text[], changes.value, true)
+                            FROM unnest(%s::uuid[], %s::jsonb[]) AS changes(tileid, value)
+                            WHERE tiles.tileid = changes.tileid
+                        """, [[nodeid], list(changes.keys()), list(changes.values())])
+                    updated = len(changes)
+        if not scanned:
+            break
+        total += updated
+        last_tileid = max(scanned)
+        if on_chunk:
+            on_chunk(len(scanned), updated, resourceids)
+    return total
+
+def run_partition_worker(index, messages, stop_event, tiles, nodeid, mapper, batch_size, partition,
+                         collect_resourceids):
+    """
+    Entry point for each worker process in a `--workers` run (see
+    `run_in_processes()`). Updates the tiles whose key falls within the
+    inclusive `(key, low, high)` partition, reporting progress after each
+    chunk through `messages`, and returns the number of tiles updated.
+    """
+
+    key, low, high = partition
+    tiles = tiles.filter(**{f"{key}__range": (low, high)})
+    return update_tile_chunks(tiles, nodeid, mapper, batch_size,
+        on_chunk=lambda scanned, updated, resourceids: messages.put(("progress", index, (scanned, updated, resourceids))),
+        stop_event=stop_event,
+        collect_resourceids=collect_resourceids,
+    )
+
 class Command(BaseCommand):
     """
     Facilitates bulk updates to nodes across the database.
 
     .. warning::
         This command is a work-in-progress
+
+    Usage:
+
+        python manage.py bulk-update-tile [node] [--set-value VALUE | --set-empty | --map-file PATH] [--regex PATTERN REPLACEMENT]
+            [--batch-size N] [--use-orm]
+            [--dry-run] [--diff-file PATH] [--workers N] [--partition-by {tileid,resourceinstanceid}]
+            [--reindex] [--reindex-batch-size N] [--reindex-workers N]
+            [--graph NAME] [--resource-ids-file PATH] [--where-value VALUE] [--only-missing]
+
+    By default, new values are written directly to the tiles table with
+    chunked `jsonb_set` UPDATE statements, one transaction per chunk. This
+    bypasses the Tile save process entirely, so tile functions are not run,
+    no edit log entries are created, and nothing is reindexed. Add
+    `--reindex` to collect the ids of all resources whose tiles changed and
+    reindex just those resources through the Elasticsearch bulk API once
+    the update is finished.
+
+    Instead of a single value, `--map-file` loads a CSV lookup table that
+    remaps values in the same pass: rows with `old_value,new_value` remap
+    matching values (e.g. old concept value ids to new ones), and rows with
+    `resourceinstanceid,new_value` assign a value per resource. Any number
+    of `--regex PATTERN REPLACEMENT` rules can be added (with or without a
+    map file) to rewrite string values that the table doesn't cover.
+
+    Use `--use-orm` to save each tile individually through
+    `Tile.update_node_value()` instead. This is much slower, but necessary
+    if the update must trigger tile functions.
+
+    Use `--workers` to split the tiles into that many disjoint key ranges
+    (by tileid, or by resourceinstanceid with `--partition-by`) and update
+    each range in a separate process with its own database connection. If
+    any worker fails, the others stop after their current chunk. Chunks that
+    were already committed stay committed, so it is safe to rerun the same
+    command to finish the job.
+
+    By default every tile in the node's nodegroup is included, for every
+    node that matches the given name. Narrow this down with `--graph`
+    (only nodes in this graph), `--resource-ids-file` (a file with one
+    resourceinstanceid per line), `--where-value` (only tiles whose current
+    value equals, or is a list containing, this value), and
+    `--only-missing` (only tiles with no value or a null value). These are
+    all applied in the database as part of each query, so that JSONB
+    containment and key-exists predicates can be answered from an index.
+
+    If no new value is given, or if `--dry-run` is used, nothing is written.
+    Instead, the current values are streamed from the database in chunks and
+    a histogram of the distinct existing values is printed. Add
+    `--diff-file` to write every old --> new change to a `.jsonl` or `.csv`
+    file for review (this is only allowed with a preview).
     """
 
     def __init__(self, *args, **kwargs):
@@ -19,6 +238,9 @@ class Command(BaseCommand):
         self.help = self.__doc__
 
     def add_arguments(self, parser):
+
+        parser.formatter_class = ArchesHelpTextFormatter
+
         parser.add_argument("node",
             help='specify the name of the node whose values will be updated.'
         )
@@ -31,19 +253,196 @@ class Command(BaseCommand):
             help='set all node values to empty. can be used to initialize '\
                  'newly created nodes. ERASES ALL EXISTING VALUES.'
         )
+        parser.add_argument("--map-file",
+            help='CSV file with a new_value column and an old_value and/or '\
+                 'resourceinstanceid column, used to remap existing values.'
+        )
+        parser.add_argument("--regex",
+            nargs=2,
+            action="append",
+            metavar=("PATTERN", "REPLACEMENT"),
+            help='regex rewrite rule applied to string values, can be used '\
+                 'more than once. rules are applied in order.'
+        )
+        parser.add_argument("--batch-size",
+            type=int,
+            default=1000,
+            help='number of tiles to update per UPDATE statement (and per '\
+                 'transaction). default 1000.'
+        )
+        parser.add_argument("--use-orm",
+            action="store_true",
+            default=False,
+            help='save each tile through the Arches ORM instead of using '\
+                 'bulk SQL. very slow, but runs tile functions.'
+        )
+        parser.add_argument("--dry-run",
+            action="store_true",
+            default=False,
+            help='preview the update without writing anything to the database.'
+        )
+        parser.add_argument("--diff-file",
+            help='path to a .jsonl or .csv file where each old --> new '\
+                 'change will be written during a preview.'
+        )
+        parser.add_argument("--workers",
+            type=int,
+            default=1,
+            help='number of worker processes to split the update across. default 1.'
+        )
+        parser.add_argument("--partition-by",
+            choices=["tileid", "resourceinstanceid"],
+            default="tileid",
+            help='key used to split the tiles into ranges when --workers > 1. default tileid.'
+        )
+        parser.add_argument("--graph",
+            help='only update nodes in this graph (name or id).'
+        )
+        parser.add_argument("--resource-ids-file",
+            help='only update tiles of the resources listed in this file, one id per line.'
+        )
+        parser.add_argument("--where-value",
+            help='only update tiles whose current value equals this value, '\
+                 'or is a list that contains it.'
+        )
+        parser.add_argument("--only-missing",
+            action="store_true",
+            default=False,
+            help='only update tiles that have no value (missing or null) for the node.'
+        )
+        parser.add_argument("--reindex",
+            action="store_true",
+            default=False,
+            help='reindex all resources whose tiles were changed by the update.'
+        )
+        parser.add_argument("--reindex-batch-size",
+            type=int,
+            default=500,
+            help='number of resources to load and index per bulk request. default 500.'
+        )
+        parser.add_argument("--reindex-workers",
+            type=int,
+            default=4,
+            help='number of concurrent bulk requests to Elasticsearch. default 4.'
+        )
 
     def handle(self, *args, **options):
 
+        diff_file = options["diff_file"]
+        if diff_file and not diff_file.endswith((".jsonl", ".csv")):
+            print("cancelling, --diff-file must end with .jsonl or .csv")
+            exit()
+
+        if options["workers"] > 1 and options["use_orm"]:
+            print("cancelling, --workers can't be combined with --use-orm")
+            exit()
+
+        mapper = self.get_mapper(options)
+
+        if diff_file and mapper is not None and not options["dry_run"]:
+            print("cancelling, --diff-file is only written during a preview, add --dry-run")
+            exit()
+
+        graph = None
+        if options["graph"]:
+            graph = get_graph(options["graph"])
+            if graph is None:
+                print("cancelling, invalid graph.")
+                exit()
+
+        resourceids = None
+        if options["resource_ids_file"]:
+            with open(options["resource_ids_file"]) as f:
+                resourceids = [uuid.UUID(line.strip()) for line in f if line.strip()]
+            print(f"limiting to {len(resourceids)} resources")
+
+        nodes = self.get_nodes(options["node"], graph=graph)
+
+        affected_resourceids = set()
+        with open(diff_file, "w", newline="") if diff_file else nullcontext() as diff_out:
+            for node in nodes:
+
+                print(f"{node.name} - {node.pk} - {node.graph.name}")
+
+                tiles = self.get_tiles(node,
+                    resourceids=resourceids,
+                    where_value=options["where_value"],
+                    only_missing=options["only_missing"],
+                )
+                if mapper is None or options["dry_run"]:
+                    self.preview(node, tiles,
+                        mapper=mapper,
+                        batch_size=options["batch_size"],
+                        diff_out=diff_out,
+                    )
+                elif options["use_orm"]:
+                    self.update_with_orm(node, tiles, mapper)
+                else:
+                    affected_resourceids |= self.update_with_sql(node, tiles, mapper,
+                        batch_size=options["batch_size"],
+                        workers=options["workers"],
+                        partition_by=options["partition_by"],
+                        collect_resourceids=options["reindex"],
+                    )
+
+        if diff_file:
+            print(f"diff written to: {diff_file}")
+
+        if options["reindex"] and affected_resourceids:
+            self.reindex(affected_resourceids,
+                batch_size=options["reindex_batch_size"],
+                workers=options["reindex_workers"],
+            )
+
+    def get_mapper(self, options):
+        """
+        Returns a `ValueMapper` for the value options that were passed, or
+        None if there are none (i.e. this is a preview of existing values).
+        """
+
+        value_options = [options["set_empty"], options["set_value"] is not None,
+                         options["map_file"] is not None or options["regex"] is not None]
+        if sum(value_options) > 1:
+            print("cancelling, use only one of --set-value, --set-empty, or --map-file/--regex")
+            exit()
+
         if options["set_empty"]:
-            value = None
-        elif options["set_value"]:
-            value = options["set_value"]
+            return ValueMapper(constant=None)
+        elif options["set_value"] is not None:
+            return ValueMapper(constant=options["set_value"])
+        elif options["map_file"]:
+            try:
+                mapper = ValueMapper.from_csv(options["map_file"], rules=options["regex"])
+            except (OSError, ValueError) as e:
+                print(f"cancelling, can't load map file: {e}")
+                exit()
+            except re.error as e:
+                print(f"cancelling, invalid regex: {e}")
+                exit()
+            print(f"map file: {len(mapper.values)} value mappings, {len(mapper.resources)} resource mappings")
+            return mapper
+        elif options["regex"]:
+            try:
+                return ValueMapper(rules=options["regex"])
+            except re.error as e:
+                print(f"cancelling, invalid regex: {e}")
+                exit()
+        return None
+
+    def get_nodes(self, name_or_id, graph=None):
+        """
+        Returns all nodes matching the given name or id (optionally only
+        within `graph`), prompting for confirmation if more than one node
+        matches a name.
+        """
 
         try:
-            id = uuid.UUID(options["node"])
+            id = uuid.UUID(name_or_id)
             nodes = Node.objects.filter(nodeid=id)
         except ValueError:
-            nodes = Node.objects.filter(name=options["node"])
+            nodes = Node.objects.filter(name=name_or_id)
+        if graph is not None:
+            nodes = nodes.filter(graph=graph)
         if len(nodes) == 0:
             print("cancelling, no nodes match this name.")
             exit()
@@ -56,24 +455,205 @@ class Command(BaseCommand):
             if not user_confirms(message="proceed?", default=False):
                 print("cancelled")
                 exit()
+        return nodes
+
+    def get_tiles(self, node, resourceids=None, where_value=None, only_missing=False):
+        """
+        Returns a queryset of the tiles to update for the node. All filters
+        compile to SQL: `where_value` to JSONB containment (`@>`) and
+        `only_missing` to a key-exists (`?`) test, both of which a GIN index
+        on tiledata can serve.
+        """
+
+        nodeid = str(node.pk)
+        tiles = Tile.objects.filter(nodegroup_id=node.nodegroup_id)
+        if resourceids is not None:
+            tiles = tiles.filter(resourceinstance_id__in=resourceids)
+        if where_value is not None:
+            tiles = tiles.filter(Q(data__contains={nodeid: where_value}) |
+                                 Q(data__contains={nodeid: [where_value]}))
+        if only_missing:
+            tiles = tiles.filter(~Q(data__has_key=nodeid) | Q(data__contains={nodeid: None}))
+        return tiles
+
+    def preview(self, node, tiles, mapper=None, batch_size=1000, diff_out=None, histogram_size=20):
+        """
+        Streams the current values for the node with a server-side cursor,
+        reading only the tile id, resource id, and node value from each tile.
+        If a `mapper` is given it is used to get the new value for each
+        tile. Changes are written to `diff_out` (an open .jsonl or .csv
+        file, if given) as they are read, and a summary of the distinct old
+        values is printed at the end.
+        """
+
+        nodeid = str(node.pk)
+        value_key = f"data__{nodeid}"
+        rows = tiles.values("tileid", "resourceinstance_id", value_key).iterator(chunk_size=batch_size)
+
+        write_diff = self.get_diff_writer(diff_out) if diff_out else None
+
+        histogram = Counter()
+        total, changed = 0, 0
+        for row in rows:
+            total += 1
+            old_value = row[value_key]
+            histogram[json.dumps(old_value, sort_keys=True)] += 1
+            new_value = mapper.map_value(old_value, row["resourceinstance_id"]) if mapper else old_value
+            if new_value != old_value:
+                changed += 1
+            if write_diff:
+                write_diff({
+                    "nodeid": nodeid,
+                    "tileid": str(row["tileid"]),
+                    "resourceinstanceid": str(row["resourceinstance_id"]),
+                    "old_value": old_value,
+                    "new_value": new_value,
+                })
+
+        print(f"  tiles: {total}")
+        if mapper:
+            print(f"  tiles that would change: {changed}")
+        print(f"  distinct existing values: {len(histogram)}")
+        for value, count in histogram.most_common(histogram_size):
+            print(f"    {count:>10}  {value}")
+        if len(histogram) > histogram_size:
+            print("    ...")
+
+    def get_diff_writer(self, diff_out):
+        """
+        Returns a function that writes one diff row to the open file, as
+        JSON lines or CSV depending on the file extension. In CSV output the
+        values are JSON-encoded so that lists and nulls survive the trip.
+        """
+
+        if not diff_out.name.endswith(".csv"):
+            return lambda diff: diff_out.write(json.dumps(diff) + "\n")
+
+        fieldnames = ["nodeid", "tileid", "resourceinstanceid", "old_value", "new_value"]
+        writer = csv.DictWriter(diff_out, fieldnames=fieldnames)
+        if diff_out.tell() == 0:
+            writer.writeheader()
+
+        def write_csv_row(diff):
+            diff["old_value"] = json.dumps(diff["old_value"])
+            diff["new_value"] = json.dumps(diff["new_value"])
+            writer.writerow(diff)
+        return write_csv_row
+
+    def update_with_orm(self, node, tiles, mapper):
+        """
+        Updates every tile one at a time with `Tile.update_node_value()`,
+        so that the full save process (tile functions, edit log, etc.) is run.
+        Tiles whose value would not change are skipped.
+        """
 
-        for node in nodes:
+        nodeid = str(node.pk)
+        for t in tiles:
+            old_value = t.data.get(nodeid)
+            new_value = mapper.map_value(old_value, t.resourceinstance_id)
+            if nodeid in t.data and new_value == old_value:
+                continue
+            Tile().update_node_value(nodeid, new_value, tileid=t.tileid)
+            print(f"{t.resourceinstance_id}: {old_value} --> {new_value}")
+        print(f"  tiles: {tiles.count()}")
 
-            print(f"{node.name} - {node.pk} - {node.graph.name}")
-            tiles = Tile.objects.filter(nodegroup_id=node.nodegroup)
+    def update_with_sql(self, node, tiles, mapper, batch_size=1000, workers=1, partition_by="tileid",
+                        collect_resourceids=False):
+        """
+        Writes the new node values to all tiles in chunks (see
+        `update_tile_chunks()`), either in this process or split across
+        multiple worker processes. Returns the set of resourceinstanceids
+        whose tiles were updated, if `collect_resourceids` is set (e.g. to
+        reindex them afterwards), otherwise an empty set.
+        """
 
-            nodeid = str(node.pk)
-            for t in tiles:
-                old_value = t.data.get(nodeid, "<no previously saved value>")
+        nodeid = str(node.pk)
 
-                if options["set_empty"] or options["set_value"]:
-                    if options["set_empty"]:
-                        new_value = None
-                    elif options["set_value"]:
-                        new_value = options["set_value"]
-                    Tile().update_node_value(nodeid, new_value, tileid=t.tileid)
-                    print(f"{t.resourceinstance_id}: {old_value} --> {new_value}")
+        start = time.monotonic()
+        if workers > 1:
+            key = "tileid" if partition_by == "tileid" else "resourceinstance_id"
+            scanned, updated, resourceids = self.update_in_workers(node, tiles, mapper, batch_size, workers, key, start,
+                                                                   collect_resourceids)
+        else:
+            scanned, updated, resourceids = 0, 0, set()
+            def report(chunk_scanned, chunk_updated, chunk_resourceids):
+                nonlocal scanned, updated
+                scanned += chunk_scanned
+                updated += chunk_updated
+                resourceids.update(chunk_resourceids)
+                self.print_progress(scanned, updated, start, end="\r")
+            update_tile_chunks(tiles, nodeid, mapper, batch_size, on_chunk=report,
+                               collect_resourceids=collect_resourceids)
+
+        self.print_progress(scanned, updated, start)
+        return resourceids
+
+    def update_in_workers(self, node, tiles, mapper, batch_size, workers, key, start, collect_resourceids=False):
+        """
+        Splits the tiles into key ranges and runs `run_partition_worker()` on
+        each in its own process, printing aggregated progress as chunks are
+        committed. Returns the total number of tiles scanned and updated and
+        the set of resourceinstanceids that were touched, or exits with an
+        error summary if any worker fails.
+        """
+
+        partitions = self.get_partitions(tiles, key, workers)
+        print(f"  partitions: {len(partitions)} (by {key})")
+
+        scanned, updated, resourceids = 0, 0, set()
+        def report(status, index, payload):
+            nonlocal scanned, updated
+            scanned += payload[0]
+            updated += payload[1]
+            resourceids.update(payload[2])
+            self.print_progress(scanned, updated, start, end="\r")
+
+        errors = run_in_processes(run_partition_worker,
+            [(tiles, str(node.pk), mapper, batch_size, partition, collect_resourceids) for partition in partitions],
+            on_message=report,
+        )
+
+        if errors:
+            self.print_progress(scanned, updated, start)
+            print("  update failed, stopped all workers after their current chunk:")
+            for index, error in errors.items():
+                if index == "main":
+                    print(f"    {error}")
                 else:
-                    print(f"{t.resourceinstance_id}: {old_value}")
+                    key, low, high = partitions[index]
+                    print(f"    partition {index} ({key} {low} - {high}):")
+                    print("      " + error.strip().replace("\n", "\n      "))
+            print("  committed chunks were kept. rerun this command to complete the update.")
+            exit(1)
+
+        return scanned, updated, resourceids
+
+    def reindex(self, resourceids, batch_size=500, workers=4):
+        """
+        Reindexes only the given resources, through the bulk API.
+        """
+
+        print(f"reindexing {len(resourceids)} resources...")
+        start = time.monotonic()
+        manager = ResourceIndexManager(batch_size=batch_size, workers=workers)
+        indexed, errors = manager.index_resources(sorted(resourceids))
+        elapsed = max(time.monotonic() - start, 0.001)
+        print(f"  resources indexed: {indexed} in {elapsed:.1f}s ({indexed / elapsed:.0f} docs/sec)")
+        if errors:
+            print(f"  {len(errors)} documents failed to index, see the log for details.")
+
+    def get_partitions(self, tiles, key, count):
+        """
+        Splits the distinct values of `key` among the tiles into `count`
+        contiguous, non-overlapping ranges of roughly equal size. Returns a
+        list of inclusive `(key, low, high)` tuples.
+        """
+
+        ranges = get_uuid_ranges(tiles.values_list(key), count)
+        return [(key, low, high) for low, high, n in ranges]
+
+    def print_progress(self, scanned, updated, start, end="\n"):
 
-            print(f"  tiles: {tiles.count()}")
+        elapsed = max(time.monotonic() - start, 0.001)
+        print(f"  tiles scanned: {scanned}, updated: {updated} in {elapsed:.1f}s "\
+              f"({scanned / elapsed:.0f} rows/sec)", end=end)
@@ -5,83 +5,118 @@ from pathlib import Path
 
 from datetime import datetime
 from django.conf import settings
+from django.db import transaction
 from django.core.management.base import BaseCommand
 from django.contrib.gis.gdal import DataSource  # type: ignore
 from django.contrib.gis.geos import MultiPolygon
 
 from arches.app.models.resource import Resource
-from arches.app.models.models import Node, File
-from arches.app.models.tile import Tile
+from arches.app.models.models import File
+
+from arches_extensions.managers import FileManager
+from arches_extensions.utils import ArchesHelpTextFormatter, chunked, get_graph, scan_directory
 
 
 class Command(BaseCommand):
+    """Find the files referenced by resources in local archive directories,
+and count orphaned File objects.
+
+    .. warning::
+        This command is a work-in-progress
+
+    Usage:
+
+        python manage.py find_files --archive-dir PATH [--graph NAME]
+            [--created-after DATE] [--created-before DATE] [--scan-workers N]
+
+    Arguments:
+
+        - `--archive-dir`: Directory to look for the files in, including all subdirectories (optional)
+        - `--graph`: Name or id of graph, only its resources will be included (optional)
+        - `--created-after`: Only include resources created on or after this date (optional)
+        - `--created-before`: Only include resources created on or before this date (optional)
+        - `--scan-workers`: Number of top-level subdirectories of the archive directory scanned concurrently (default=4)
+
+    All file references in the file-list nodes of the selected resources
+    are resolved to their File objects with a single query. The archive
+    directory is scanned once into an index of file names, and each
+    referenced file is then looked up by name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.help = self.__doc__
 
     def add_arguments(self, parser):
-        pass
+
+        parser.formatter_class = ArchesHelpTextFormatter
+
+        parser.add_argument("--archive-dir")
+        parser.add_argument("--graph")
+        parser.add_argument("--created-after")
+        parser.add_argument("--created-before")
+        parser.add_argument("--scan-workers", type=int, default=4)
 
     def handle(self, *args, **options):
 
-        fnodes = Node.objects.filter(datatype="file-list", graph__name="Scout Report")
-        nids = [str(i) for i in fnodes.values_list("pk", flat=True)]
-        ngs = fnodes.values_list("nodegroup", flat=True)
+        if options["archive_dir"] and not Path(options["archive_dir"]).is_dir():
+            print(f"cancelling, archive directory not found: {options['archive_dir']}")
+            exit()
 
-        resources = Resource.objects.filter(createdtime__gte="2019-10-21", createdtime__lte="2020-06-30",graph__name="Scout Report")
-        print(resources.count())
-        res_with_img = []
+        resources = Resource.objects.all()
+        if options["graph"]:
+            graph = get_graph(options["graph"])
+            if graph is None:
+                print("cancelling, invalid graph.")
+                exit()
+            resources = resources.filter(graph=graph)
+        if options["created_after"]:
+            resources = resources.filter(createdtime__date__gte=options["created_after"])
+        if options["created_before"]:
+            resources = resources.filter(createdtime__date__lte=options["created_before"])
+        print(f"resources: {resources.count()}")
+
+        name_index = None
+        if options["archive_dir"]:
+            name_index = scan_directory(options["archive_dir"], workers=options["scan_workers"])
+            print(f"files in {options['archive_dir']}: {sum(len(i) for i in name_index.values())}")
+
+        res_with_files = set()
+        references = 0
+        unresolved = 0
         local_files = []
-        for res in resources:
-            tiles = Tile.objects.filter(nodegroup__in=ngs, resourceinstance_id=res.pk)
-            if tiles.count() > 0:
-                res_with_img.append(res)
-
-            for t in tiles:
-                for k in t.data.keys():
-                    if k in nids and t.data[k] is not None:
-                        for f in t.data[k]:
-                            fileid = f['file_id']
-                            ff = File.objects.get(pk=fileid)
-                            local_path = Path("../photo-archive", str(ff.path).split("/")[-1])
-                            if local_path.is_file():
-                                print("resource: ", res.pk)
-                                print(res.createdtime)
-                                print(local_path)
-                                local_files.append(local_path)
-        print(len(res_with_img))
-        print(len(local_files))
+        for resid, createdtime, fileid, name, path in FileManager().iterate_file_references(resources):
+            res_with_files.add(resid)
+            references += 1
+            if path is None:
+                unresolved += 1
+                continue
+            if name_index is not None:
+                for local_path in name_index.get(Path(path).name, []):
+                    print("resource: ", resid)
+                    print(createdtime)
+                    print(local_path)
+                    local_files.append(local_path)
+        print(f"resources with files: {len(res_with_files)}")
+        print(f"file references: {references} (without a File object: {unresolved})")
+        if name_index is not None:
+            print(f"found in archive: {len(local_files)}")
 
         print("---")
 
-
-        tiles = Tile.objects.filter(nodegroup__in=ngs)
-        used_ids = set()
-        file_entries = []
-        for t in tiles:
-            to_save = False
-            resid = str(t.resourceinstance.pk)
-            tileid = str(t.pk)
-            for k in t.data.keys():
-                if k in nids and t.data[k] is not None:
-                    for f in t.data[k]:
-                        fileid = f['file_id']
-                        f['resourceinstanceid'] = resid
-                        f['tileid'] = tileid
-                        used_ids.add(fileid)
-                        file_entries.append(f)
-
-        file_entries.sort(key=lambda k:k['name'])
-        print(f"number of file entries in tiles: {len(file_entries)}")
-        fileids_in_tiles = [i['file_id'] for i in file_entries]
-#        for fe in file_entries:
-#            if fileids_in_tiles.count(fe['file_id']) > 1:
-#                print(fe['resourceinstanceid'], fe['file_id'], fe['name'])
-
         all_files = File.objects.all()
         print(f"total number of File objects: {all_files.count()}")
 
-        orphan_files = File.objects.exclude(pk__in=used_ids)
-        print(f"orphaned File objects: {orphan_files.count()}")
+        orphan_count = sum(1 for orphan in FileManager().iterate_orphan_files())
+        print(f"orphaned File objects: {orphan_count}")
 
-    def load_areas(self, source, group_names, level="", category=""):
+    def load_areas(self, source, group_names, level="", category="", batch_size=1000):
+        """
+        Loads each polygon feature in the source as a ManagementArea, in
+        batches: the features are read from the layer as a stream, each
+        batch of areas is inserted with `bulk_create` along with all of its
+        group memberships, and each batch is one transaction.
+        """
 
         # generate load_id from filename and time.
         source_file = os.path.basename(source)
@@ -121,29 +156,40 @@ class Command(BaseCommand):
         # load_source ensures this won't fail.
         name_field = [i for i in dataset.fields if i.lower() == "name"][0]
 
+        extra = {}
+        if category != "":
+            extra["category"] = cat
+        if level != "":
+            extra["management_level"] = level
+
+        def iterate_areas():
+            for feature in dataset:
+                if feature.geom.geom_type == "Polygon":
+                    geom = MultiPolygon(feature.geom.geos)
+                elif feature.geom.geom_type == "MultiPolygon":
+                    geom = feature.geom.geos
+                else:
+                    print("skipping invalid geom type: " + feature.geom.geom_type)
+                    continue
+                yield ManagementArea(name=feature.get(name_field), geom=geom, load_id=load_id, **extra)
+
+        # group memberships are inserted directly into the through table
+        areas_field = ManagementAreaGroup.areas.field
+        group_attr, area_attr = areas_field.m2m_field_name(), areas_field.m2m_reverse_field_name()
+        if ManagementAreaGroup.areas.reverse:
+            group_attr, area_attr = area_attr, group_attr
+        Membership = ManagementAreaGroup.areas.through
+
         load_ct = 0
-        for feature in dataset:
-            geom = None
-            if feature.geom.geom_type == "Polygon":
-                geom = MultiPolygon(feature.geom.geos)
-            elif feature.geom.geom_type == "MultiPolygon":
-                geom = feature.geom.geos
-            else:
-                print("skipping invalid geom type: " + feature.geom.geom_type)
-            new_ma = ManagementArea.objects.create(
-                name=feature.get(name_field),
-                geom=geom,
-                load_id=load_id,
-            )
-            if category != "":
-                new_ma.category = cat
-            if level != "":
-                new_ma.management_level = level
-            new_ma.save()
-
-            for group in add_to_groups:
-                group.areas.add(new_ma)
-            load_ct += 1
+        for batch in chunked(iterate_areas(), batch_size):
+            with transaction.atomic():
+                areas = ManagementArea.objects.bulk_create(batch)
+                Membership.objects.bulk_create([
+                    Membership(**{f"{group_attr}_id": group.pk, f"{area_attr}_id": area.pk})
+                    for area in areas for group in add_to_groups
+                ])
+            load_ct += len(areas)
+            print(f"  {load_ct} loaded", end="\r")
 
         print(f"{load_ct} Management Areas loaded.")
         print(f"load id: {load_id}")
@@ -1,17 +1,32 @@
+import os
 import csv
+import json
+import hashlib
 import logging
+import zipfile
 from pathlib import Path
-from zipfile import ZipFile
-from time import strftime, localtime
+from datetime import datetime
+from collections import Counter
+from time import strftime, localtime, time
 
+from django.db.models import F, JSONField
+from django.db.models.fields.json import KeyTextTransform
+from django.utils.translation import get_language
 from django.core.management.base import BaseCommand
 
-from arches.app.models.models import Node, File
+from arches.app.models.models import Node, File, ResourceInstance, TileModel
 from arches.app.models.resource import Resource
 from arches.app.models.graph import Graph
-from arches.app.models.tile import Tile
 
-from arches_extensions.utils import ArchesHelpTextFormatter
+from arches_extensions.managers import FileManager
+from arches_extensions.utils import (
+    ArchesHelpTextFormatter,
+    DirectoryArchiveWriter,
+    ZipArchiveWriter,
+    chunked,
+    ordered_map,
+    user_confirms,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +47,71 @@ specific resources.
         - `--graph`: Name of graph, all instances will be included (optional)
         - `--make-csv`: Exports a CSV list of all file info, named for graph or instance (default=False)
         - `--make-archive`: Creates a zip archive of all files, named for graph or instance (default=False)
-        - `--include-orphans`: Includes File objects that are no longer in tile data, but do exist in the database (default=False)
+        - `--include-orphans`: Includes File objects that are no longer in tile data, but do exist in the database, the same ones `--find-orphans` reports (default=False)
+        - `--max-archive-size`: Split the archive into volumes of at most this many GB (optional, 1 with `--incremental`)
+        - `--readers`: Number of files read from storage concurrently while archiving (default=4)
+        - `--verify`: Check that each file exists in storage and isn't empty, and write a report of missing files (default=False)
+        - `--verify-workers`: Number of concurrent checks against the storage backend (default=16)
+        - `--recheck-after`: Days before a file found by a previous `--verify` is checked again (default=7)
+        - `--manifest`: Write a manifest with the SHA-256 and size of each file, and a report of duplicate files (default=False)
+        - `--hash-workers`: Number of files hashed concurrently (default=number of CPUs)
+        - `--cache`: Path to the cache file shared between runs (default=.get_files_cache.json)
+        - `--incremental`: With `--make-archive`, only export files that are new or changed since the last export, and resume an interrupted one (default=False)
+        - `--export-dir`: With `--incremental`, copy files into this directory tree instead of new zip volumes (optional)
+        - `--find-orphans`: Write a report of all File objects that aren't referenced in any tile (default=False)
+        - `--delete-orphans`: Delete those File objects (and their files) after confirmation (default=False)
+
+    Archives are streamed: files are copied from storage in chunks by a pool
+    of reader threads while a single writer adds them to the zip, so memory
+    use doesn't depend on file sizes. Already-compressed types (images,
+    video, etc.) are stored without compressing them again, and duplicate
+    file names get a numbered suffix. Each file is read in full (spooled to
+    a temporary file) before it is added, so files that can't be read,
+    even partway through, are left out of the archive and listed at the
+    end.
+
+    Rows are produced as a stream: tiles are read from the database in
+    chunks, already ordered by resource name, and each row goes to the CSV
+    (and its file to the archive) as soon as it is found, so memory use
+    stays flat however many files there are.
+
+    With `--verify`, each file is checked against the storage backend (a
+    stat for local storage, or the backend's `size()` and
+    `get_modified_time()` for remote ones like S3) by a pool of threads,
+    and the result is added to the CSV as a `status` column. Files that are
+    missing or empty are listed in `<scope>__missing.csv` and left out of
+    the archive. Results are cached by path along with each file's size
+    and modified time: local files are always checked (it's cheap), while
+    remote files that were found are only checked again after
+    `--recheck-after` days.
+
+    With `--manifest`, the content of each file is hashed (SHA-256, read in
+    chunks) by a pool of threads, and written with its size to
+    `<scope>__manifest.csv`, and as a `sha256` column in the CSV. Digests
+    are cached with the file's size and modified time, so a rerun only
+    reads files that are new or have changed. Files with identical content
+    are listed in groups in `<scope>__duplicates.csv`.
+
+    With `--incremental`, each exported file is recorded (with its size,
+    modified time, digest if `--manifest` is used, and where it went) in
+    `<scope>__files__exported.jsonl` as soon as it is written. Later runs
+    only export files that aren't recorded or whose size, modified time,
+    or digest has changed, into new zip volumes named for the run (so
+    earlier ones are left as they are), or into `--export-dir`, mirroring
+    the storage paths. An interrupted run picks up after the last recorded
+    file. If the process was killed while a zip volume was open, that
+    volume is unreadable, so it is renamed to `.partial` and its files are
+    exported again. To limit how much that can be, incremental zip exports
+    are always split into volumes, of `--max-archive-size` or 1 GB by
+    default, and each volume is closed before the next one is started.
+
+    `--find-orphans` looks for File objects that no tile references, with a
+    single query that expands the values of all file-list nodes (in tile
+    data and in pending provisional edits) and anti-joins them with the
+    files table, and writes them to
+    `<scope>__orphans.csv`. Without `--resource` or `--graph` this covers
+    all File objects, including those that aren't attached to a tile at
+    all. `--delete-orphans` then deletes them in batches.
 
     """
 
@@ -49,6 +128,18 @@ specific resources.
         parser.add_argument("--make-csv", action="store_true")
         parser.add_argument("--make-archive", action="store_true")
         parser.add_argument("--include-orphans", action="store_true")
+        parser.add_argument("--max-archive-size", type=float)
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--verify", action="store_true")
+        parser.add_argument("--verify-workers", type=int, default=16)
+        parser.add_argument("--recheck-after", type=float, default=7)
+        parser.add_argument("--manifest", action="store_true")
+        parser.add_argument("--hash-workers", type=int, default=os.cpu_count())
+        parser.add_argument("--cache", default=".get_files_cache.json")
+        parser.add_argument("--incremental", action="store_true")
+        parser.add_argument("--export-dir")
+        parser.add_argument("--find-orphans", action="store_true")
+        parser.add_argument("--delete-orphans", action="store_true")
 
     def handle(self, *args, **options):
 
@@ -56,47 +147,469 @@ specific resources.
 
         ## get all relevant file objects
         if options["resource"]:
-            scopes.append((options["resource"], File.objects.filter(tile__resourceinstance_id=scope)))
+            scopes.append((options["resource"], File.objects.filter(tile__resourceinstance_id=options["resource"])))
         elif options["graph"]:
             scopes.append((options["graph"], File.objects.filter(tile__resourceinstance__graph__name=options["graph"])))
         else:
             for graph in Graph.objects.filter(isresource=True).exclude(name="Arches System Settings"):
                 scopes.append((graph.name, File.objects.filter(tile__resourceinstance__graph=graph)))
 
-        ## process all scopes
+        if options["find_orphans"] or options["delete_orphans"]:
+            if options["resource"] or options["graph"]:
+                scope, files = scopes[0]
+            else:
+                scope, files = "all", None
+            self.find_orphans(files, Path(f"{scope}__orphans.csv"), delete=options["delete_orphans"])
+            return
+
+        cache_path = Path(options["cache"])
+        cache = self.load_cache(cache_path)
+
+        ## process all scopes, streaming rows from the database through the
+        ## verification, csv writer and archive writer as they are found
         for scope, files in scopes:
             print(f"Getting files for: {scope}")
-            info = self.collect_file_info(files, include_orphans=options["include_orphans"])
-            print("  --all info collected")
+            suffix = "__withorphans" if options["include_orphans"] else ""
+            stats = Counter()
+            rows = self.iterate_file_info(files, include_orphans=options["include_orphans"], stats=stats)
+            fields = self.csv_fields
+            if options["verify"]:
+                rows = self.verify(rows, Path(f"{scope}__missing{suffix}.csv"), cache,
+                    workers=options["verify_workers"],
+                    recheck_after=options["recheck_after"],
+                    stats=stats,
+                )
+                fields = fields + ["status"]
+            if options["manifest"]:
+                rows = self.hash_files(rows, f"{scope}{suffix}", cache,
+                    workers=options["hash_workers"],
+                    recheck_after=options["recheck_after"],
+                    stats=stats,
+                )
+                fields = fields + ["sha256"]
             if options["make_csv"]:
-                if len(info) == 0:
-                    print("no data to write, skipping")
+                rows = self.write_csv(rows, Path(f"{scope}__filelist{suffix}.csv"), fields)
+            max_size = int(options["max_archive_size"] * 1024 ** 3) if options["max_archive_size"] else None
+            if options["make_archive"] and options["incremental"]:
+                self.export_archive(rows, f"{scope}__files{suffix}", cache,
+                    max_size=max_size,
+                    readers=options["readers"],
+                    export_dir=options["export_dir"],
+                    recheck_after=options["recheck_after"],
+                )
+                self.save_cache(cache_path, cache)
+            elif options["make_archive"]:
+                self.make_archive(rows, f"{scope}__files{suffix}", max_size=max_size, readers=options["readers"])
+            else:
+                for row in rows:
+                    pass
+            print(f"Tiles with files in them: {stats['tiles']}")
+            print(f"Files in tiles without fileids: {stats['without_id']}")
+            print(f"Number of files actually referenced in tiles: {stats['matched']}")
+            print(f"Number of orphaned files: {stats['orphans']}")
+            if options["verify"]:
+                print(f"Files missing or empty in storage: {stats['missing']}")
+            if options["manifest"]:
+                print(f"Files hashed: {stats['hashed']} (read: {stats['read']}, cached: {stats['hashed'] - stats['read']})")
+                print(f"Duplicate files: {stats['duplicates']} in {stats['duplicate_groups']} groups "\
+                      f"({stats['duplicate_bytes'] / 1024 ** 2:.1f} MB)")
+            if options["verify"] or options["manifest"]:
+                self.save_cache(cache_path, cache)
+
+    csv_fields = [
+        "resource id",
+        "resource name",
+        "node name",
+        "file id",
+        "file name (original)",
+        "file name (actual)",
+        "last modified",
+    ]
+
+    def find_orphans(self, files, report_path, delete=False, batch_size=1000):
+        """
+        Writes all orphaned File objects (within `files`, if given) to the
+        report, and deletes them in batches if requested.
+        """
+
+        manager = FileManager()
+        count = 0
+        with open(report_path, "w", newline="") as o:
+            writer = csv.writer(o)
+            writer.writerow(["file id", "file path", "tile id"])
+            for row in manager.iterate_orphan_files(files):
+                writer.writerow(row)
+                count += 1
+        print(f"Orphaned File objects: {count}")
+        if count == 0:
+            report_path.unlink()
+            return
+        print(f"  --written to {report_path}")
+
+        if delete:
+            if not user_confirms(f"delete {count} orphaned File objects and their files?", default=False):
+                print("cancelled")
+                return
+            fileids = (fileid for fileid, path, tileid in manager.iterate_orphan_files(files))
+            deleted = manager.delete_files(fileids, batch_size=batch_size)
+            print(f"  --deleted: {deleted}")
+
+    def write_csv(self, rows, path, fields=None):
+        """
+        Writes each row to the csv as it comes through, and passes it on.
+        """
+
+        count = 0
+        with open(path, "w", newline="") as o:
+            writer = csv.DictWriter(o, fieldnames=fields or self.csv_fields, extrasaction="ignore")
+            writer.writeheader()
+            for row, f in rows:
+                writer.writerow(row)
+                count += 1
+                yield row, f
+        if count == 0:
+            path.unlink()
+            print("no data to write, skipping")
+        else:
+            print(f"  --{count} rows written to {path}")
+
+    def verify(self, rows, report_path, cache, workers=16, recheck_after=7, stats=None):
+        """
+        Checks the file of each row in storage, with up to `workers` checks
+        running at once, and passes the rows on in order with a `status` of
+        "ok", "missing", "empty", or "error: ...". Missing and empty files
+        are written to the report, and passed on without their file.
+        """
+
+        stats = stats if stats is not None else Counter()
+        recheck_before = time() - recheck_after * 86400
+
+        def check(item):
+            row, f = item
+            if f is None:
+                return None
+            return self.stat_file(f, cache.get(f.path.name), recheck_before)
+
+        count = 0
+        with open(report_path, "w", newline="") as o:
+            writer = csv.DictWriter(o, fieldnames=self.csv_fields + ["file path", "status"], extrasaction="ignore")
+            writer.writeheader()
+            for (row, f), result in ordered_map(check, rows, workers=workers, ahead=workers * 4):
+                if result is None:
+                    row["status"] = "missing"
+                elif "error" in result:
+                    row["status"] = f"error: {result['error']}"
                 else:
-                    for i in info:
-                        del i['file path']
-                    csv_name = f"{scope}__filelist"
-                    if options["include_orphans"]:
-                        csv_name += "__withorphans"
-                    with open(f"{csv_name}.csv", "w") as o:
-                        writer = csv.DictWriter(o, fieldnames=info[0].keys())
-                        writer.writeheader()
-                        writer.writerows(info)
-
-            if options["make_archive"]:
-                if len(info) == 0:
-                    print("no files to archive, skipping")
+                    self.update_cache(cache, f.path.name, result)
+                    row["status"] = "ok" if result["size"] else "empty"
+                if row["status"] in ("missing", "empty"):
+                    writer.writerow(row)
+                    stats["missing"] += 1
+                    count += 1
+                    f = None
+                yield row, f
+        if count == 0:
+            report_path.unlink()
+        else:
+            print(f"  --{count} missing files written to {report_path}")
+
+    def stat_file(self, f, cached=None, recheck_before=0):
+        """
+        Returns a dict with the `size` and `mtime` of the file in storage
+        (and when it was `checked`), None if it doesn't exist, or a dict with
+        the `error` if it can't be checked. A remote file's `cached` result
+        is reused if it was checked after `recheck_before`.
+        """
+
+        storage, name = f.path.storage, f.path.name
+        try:
+            local_path = storage.path(name)
+        except NotImplementedError:
+            local_path = None
+
+        try:
+            if local_path is not None:
+                stat = os.stat(local_path)
+                return {"size": stat.st_size, "mtime": stat.st_mtime, "checked": time()}
+            if cached and cached.get("checked", 0) > recheck_before:
+                return cached
+            size = storage.size(name)
+            try:
+                mtime = storage.get_modified_time(name).timestamp()
+            except NotImplementedError:
+                mtime = None
+            return {"size": size, "mtime": mtime, "checked": time()}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            ## remote backends raise their own errors for missing files
+            try:
+                if not storage.exists(name):
+                    return None
+            except Exception:
+                pass
+            return {"error": repr(e)}
+
+    def hash_files(self, rows, name, cache, workers=4, recheck_after=7, stats=None):
+        """
+        Hashes the file of each row (once per file) with up to `workers`
+        files read at once, and passes the rows on in order with a `sha256`
+        (repeated rows for the same file get the digest of the first one).
+        Writes the manifest as the rows go by, and the duplicate groups at
+        the end.
+        """
+
+        stats = stats if stats is not None else Counter()
+        recheck_before = time() - recheck_after * 86400
+        digests = {}
+        sha256_by_fileid = {}
+
+        def first_seen():
+            seen = set()
+            for row, f in rows:
+                first = f is not None and row["file id"] not in seen
+                if first:
+                    seen.add(row["file id"])
+                yield row, f, first
+
+        def digest(item):
+            row, f, first = item
+            if not first:
+                return None
+            return self.digest_file(f, cache.get(f.path.name), recheck_before)
+
+        manifest_path = Path(f"{name}__manifest.csv")
+        with open(manifest_path, "w", newline="") as o:
+            writer = csv.writer(o)
+            writer.writerow(["file id", "file path", "size", "sha256"])
+            for (row, f, first), result in ordered_map(digest, first_seen(), workers=workers, ahead=workers * 2):
+                if result is not None and "error" not in result:
+                    if result.pop("read", False):
+                        stats["read"] += 1
+                    stats["hashed"] += 1
+                    self.update_cache(cache, f.path.name, result)
+                    writer.writerow([row["file id"], f.path.name, result["size"], result["sha256"]])
+                    digests.setdefault((result["sha256"], result["size"]), []).append((row["file id"], f.path.name))
+                    sha256_by_fileid[row["file id"]] = result["sha256"]
+                elif result is not None:
+                    logger.error(f"failed to hash {f.path.name}: {result['error']}")
+                row["sha256"] = sha256_by_fileid.get(row["file id"], "") if f is not None else ""
+                yield row, f
+        print(f"  --manifest written to {manifest_path}")
+
+        duplicates_path = Path(f"{name}__duplicates.csv")
+        with open(duplicates_path, "w", newline="") as o:
+            writer = csv.writer(o)
+            writer.writerow(["sha256", "size", "file id", "file path"])
+            for (sha256, size), group in digests.items():
+                if len(group) < 2:
+                    continue
+                stats["duplicate_groups"] += 1
+                stats["duplicates"] += len(group) - 1
+                stats["duplicate_bytes"] += size * (len(group) - 1)
+                for fileid, path in group:
+                    writer.writerow([sha256, size, fileid, path])
+        if stats["duplicate_groups"]:
+            print(f"  --duplicates written to {duplicates_path}")
+        else:
+            duplicates_path.unlink()
+
+    def digest_file(self, f, cached=None, recheck_before=0):
+        """
+        Returns the `stat_file()` result for the file with its `sha256`
+        added, reusing the cached digest if the size and modified time are
+        unchanged. Returns None if the file doesn't exist.
+        """
+
+        result = self.stat_file(f, cached, recheck_before)
+        if result is None or "error" in result:
+            return result
+        if cached and cached.get("sha256") and \
+                (cached.get("size"), cached.get("mtime")) == (result["size"], result["mtime"]):
+            return {**result, "sha256": cached["sha256"]}
+        try:
+            sha256 = hashlib.sha256()
+            with f.path.storage.open(f.path.name, "rb") as content:
+                while chunk := content.read(1024 * 1024):
+                    sha256.update(chunk)
+        except Exception as e:
+            return {"error": repr(e)}
+        return {**result, "sha256": sha256.hexdigest(), "read": True}
+
+    def update_cache(self, cache, name, result):
+        """
+        Stores a file's latest `stat_file()` result in the cache, keeping its
+        digest only while the size and modified time are unchanged.
+        """
+
+        cached = cache.get(name, {})
+        if "sha256" in cached and "sha256" not in result and \
+                (cached.get("size"), cached.get("mtime")) == (result["size"], result["mtime"]):
+            result = {**result, "sha256": cached["sha256"]}
+        cache[name] = result
+
+    def load_cache(self, path):
+
+        if not path.is_file():
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_cache(self, path, cache):
+
+        with open(path, "w") as f:
+            json.dump(cache, f)
+
+    def make_archive(self, rows, zip_name, max_size=None, readers=4):
+        """
+        Streams the file of each row into a zip archive (once per file). See
+        `ZipArchiveWriter`.
+        """
+
+        def entries():
+            seen = set()
+            for row, f in rows:
+                if f is None or row["file id"] in seen:
+                    continue
+                seen.add(row["file id"])
+                yield row["file id"], Path(f.path.name).name, f.path.storage, f.path.name
+
+        archived, failed = 0, []
+        with ZipArchiveWriter(zip_name, max_size=max_size, readers=readers) as writer:
+            for fileid, arcname, volume, size, error in writer.write(entries()):
+                if error:
+                    failed.append((fileid, error))
                 else:
-                    usefiles = File.objects.filter(fileid__in=[i['file id'] for i in info])
-                    zip_name = f"{scope}__files"
-                    if options["include_orphans"]:
-                        zip_name += "__withorphans"
-                    with ZipFile(f"{zip_name}.zip", "w") as zip_file:
-                        for f in usefiles:
-                            with f.path.open("rb") as content:
-                                zip_file.writestr(f.path.name.split("/")[-1], content.read())
-
-    def collect_file_info(self, files, include_orphans=False):
+                    archived += 1
+        if not writer.volumes:
+            print("no files to archive, skipping")
+            return
+        print(f"  --{archived} files archived in: {', '.join(str(v) for v in writer.volumes)}")
+        for fileid, error in failed:
+            print(f"  --failed: {fileid} {error}")
+
+    ## an interrupted export loses its open zip volume, so never write more
+    ## than this to one volume unless a size is given
+    incremental_volume_size = 1024 ** 3
+
+    def export_archive(self, rows, name, cache, max_size=None, readers=4, export_dir=None, recheck_after=7):
+        """
+        Exports the files of the rows that are new or changed since the last
+        export, recording each one in the export manifest as it is written.
+        """
+
+        manifest_path = Path(f"{name}__exported.jsonl")
+        records = self.load_export_manifest(manifest_path)
+        print(f"  --previously exported files: {len(records)}")
+        recheck_before = time() - recheck_after * 86400
+
+        def check(item):
+            row, f = item
+            if f is None:
+                return None
+            return self.stat_file(f, cache.get(f.path.name), recheck_before)
+
+        pending = {}
+        skipped = Counter()
+
+        def entries():
+            seen = set()
+            for (row, f), result in ordered_map(check, rows, workers=readers * 2):
+                fileid = row["file id"]
+                if f is None or fileid in seen:
+                    continue
+                seen.add(fileid)
+                if result is None or "error" in result:
+                    skipped["unavailable"] += 1
+                    continue
+                self.update_cache(cache, f.path.name, result)
+                record = {
+                    "file id": fileid,
+                    "name": f.path.name,
+                    "size": result["size"],
+                    "mtime": result["mtime"],
+                    "sha256": row.get("sha256") or cache[f.path.name].get("sha256"),
+                }
+                previous = records.get(fileid)
+                if previous and all(previous.get(k) == record[k] for k in ("name", "size", "mtime")) \
+                        and (not record["sha256"] or previous.get("sha256") in (None, record["sha256"])):
+                    skipped["unchanged"] += 1
+                    continue
+                pending[fileid] = record
+                if export_dir:
+                    yield fileid, f.path.name, f.path.storage, f.path.name
+                else:
+                    yield fileid, Path(f.path.name).name, f.path.storage, f.path.name
+
+        if export_dir:
+            writer = DirectoryArchiveWriter(export_dir, readers=readers)
+        else:
+            ## new volumes for each run, avoiding names used in earlier ones
+            run_name = f"{name}__{datetime.now():%Y%m%d-%H%M%S}"
+            names = {r["arcname"] for r in records.values() if str(r["target"]).endswith(".zip")}
+            writer = ZipArchiveWriter(run_name, max_size=max_size or self.incremental_volume_size,
+                                      readers=readers, names=names)
+
+        exported, failed = 0, []
+        with writer, open(manifest_path, "a") as manifest:
+            for fileid, arcname, target, size, error in writer.write(entries()):
+                record = pending.pop(fileid)
+                if error:
+                    failed.append((fileid, error))
+                    continue
+                record.update({"arcname": arcname, "target": str(target), "exported": datetime.now().isoformat()})
+                manifest.write(json.dumps(record) + "\n")
+                manifest.flush()
+                exported += 1
+
+        print(f"  --exported: {exported}, unchanged: {skipped['unchanged']}, unavailable: {skipped['unavailable']}")
+        if writer.volumes:
+            print(f"  --written to: {', '.join(str(v) for v in writer.volumes)}")
+        for fileid, error in failed:
+            print(f"  --failed: {fileid} {error}")
+
+    def load_export_manifest(self, path):
+        """
+        Returns the latest export record of each file id in the manifest,
+        leaving out records in zip volumes that were never closed (which are
+        renamed to `.partial`) so that those files are exported again.
+        """
+
+        records = {}
+        if path.is_file():
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records[record["file id"]] = record
+
+        broken = set()
+        for target in {r["target"] for r in records.values() if r["target"].endswith(".zip")}:
+            target = Path(target)
+            if target.is_file() and not zipfile.is_zipfile(target):
+                target.rename(target.with_name(target.name + ".partial"))
+                print(f"  --incomplete volume renamed to {target.name}.partial, its files will be exported again")
+                broken.add(str(target))
+            elif not target.is_file() and not Path(f"{target}.partial").is_file():
+                logger.warning(f"exported volume {target} not found")
+            if Path(f"{target}.partial").is_file():
+                broken.add(str(target))
+        return {k: r for k, r in records.items() if r["target"] not in broken}
+
+    def iterate_file_info(self, files, include_orphans=False, stats=None, chunk_size=2000):
+        """
+        Yields a `(row, file)` pair for each file referenced in the tiles
+        that contain `files`, with `file` being None if the File object isn't
+        found. Tiles are read in chunks, ordered by the stored resource name
+        in the database, and each chunk's files are loaded with one query.
+        The name in each row is that same stored name, so no descriptors are
+        computed per row. The orphaned files among `files` are counted with
+        `FileManager.iterate_orphan_files()`, as `--find-orphans` does, and
+        yielded at the end if requested.
+        """
+
         print(f"File objects: {files.count()}")
+        stats = stats if stats is not None else Counter()
 
         ## quick check for missing files
 #        missing = []
@@ -107,91 +620,96 @@ specific resources.
 #        print(f"Missing files to be skipped: {len(missing)}")
 #        files = [i for i in files if not i in missing]
 
-        def lookup_file_info(id):
+        node_lookup = {str(n.pk): n for n in Node.objects.filter(datatype="file-list")}
+        ## the stored name is localized JSON in newer Arches versions, and
+        ## plain text in older ones
+        if isinstance(ResourceInstance._meta.get_field("name"), JSONField):
+            resource_name = KeyTextTransform(get_language(), "resourceinstance__name")
+        else:
+            resource_name = F("resourceinstance__name")
+        tiles = TileModel.objects.filter(pk__in=files.order_by().values("tile_id")) \
+            .annotate(resource_name=resource_name) \
+            .order_by("resource_name", "resourceinstance_id", "tileid")
+
+        def file_entries(tile):
+            for k, v in (tile.data or {}).items():
+                if k in node_lookup and v:
+                    for i in v:
+                        yield node_lookup[k], i
+
+        def lookup_file_info(f, last_modified=None):
 
             info = {}
-            f = file_lookup.get(id)
             if f:
-                if f.tile:
-                    for k, v in tile.data.items():
-                        node = node_lookup.get(k, Node.objects.get(pk=k))
-                        if node.datatype == "file-list":
-                            for fl in v:
-                                if fl["file_id"] == str(f.pk):
-                                    lm = fl["lastModified"]
-                                    lm = strftime('%Y-%m-%d %H:%M:%S', localtime(lm/1000))
-                info["name"] = Path(file_lookup[id].path.url).name
-                info["path"] = file_lookup[id].path.url if file_lookup[id].path.url.startswith("http") else Path(file_lookup[id].path.path).name
-                info["last_modified"] = lm
+                url = f.path.url
+                info["name"] = Path(url).name
+                info["path"] = url if url.startswith("http") else Path(f.path.path).name
+                if last_modified is not None:
+                    info["last_modified"] = strftime('%Y-%m-%d %H:%M:%S', localtime(last_modified/1000))
             return info
 
-        ## iterate files and create a lookup for tiles they are referenced by
-        file_lookup = {}
-        tile_lookup = {}
-        for f in files:
-            file_lookup[str(f.fileid)] = f
-            tileid = str(f.tile_id)
-            if tileid not in tile_lookup:
-                tile_lookup[tileid] = Tile.objects.get(pk=tileid)
-        print(f"Tiles with files in them: {len(tile_lookup)}")
-
-        ## iterate all tiles that have been identified to have files,
-        ## and collect the file ids that are stored in the tile data
-        ## also make lookups for resources and nodes along the way for later use
-        node_lookup = {}
-        res_lookup = {}
-        file_info = []
-        files_without_id = []
-        orphan_total = 0
-        matched_total = 0
-        for t, tile in tile_lookup.items():
-            resid = str(tile.resourceinstance_id)
-            res = res_lookup.get(resid, Resource.objects.get(pk=resid))
-            if resid not in res_lookup:
-                res_lookup[resid] = res
-            found_ids = []
-            for k, v in tile.data.items():
-                node = node_lookup.get(k, Node.objects.get(pk=k))
-                if k not in node_lookup:
-                    node_lookup[k] = node
-                if node.datatype == "file-list":
-                    for i in v:
-                        id = str(i['file_id'])
-                        if id == "None":
-                            files_without_id.append(i)
-                            continue
-                        found_ids.append(id)
-                        matched_total += 1
-                        finfo = lookup_file_info(id)
-                        file_info.append({
-                            "resource id": resid,
-                            "resource name": res.displayname(),
-                            "node name": node.name,
-                            "file id": id,
-                            "file name (original)": i['name'],
-                            "file name (actual)": finfo.get("name", "n/a"),
-                            "file path": finfo.get("path", "n/a"),
-                            "last modified": finfo.get("last_modified", "n/a")
-                        })
-            orphans = File.objects.filter(tile=tile).exclude(fileid__in=found_ids)
-            orphan_total += orphans.count()
-            if include_orphans:
-                for orphan in orphans:
-                    id = str(orphan.pk)
-                    finfo = lookup_file_info(id)
-                    file_info.append({
+        def resource_names(stored):
+            ## print the stored name that the rows are ordered by, computing
+            ## it (once per resource) only where it was never stored
+            names = dict(stored)
+            unnamed = [resid for resid, name in names.items() if not name]
+            for resid, res in Resource.objects.in_bulk(unnamed).items():
+                names[str(resid)] = res.displayname()
+            return names
+
+        for chunk in chunked(tiles.iterator(chunk_size=chunk_size), chunk_size):
+            stats["tiles"] += len(chunk)
+
+            ## the files that these tiles point to, wherever they are attached
+            referenced = {str(i["file_id"]) for tile in chunk for node, i in file_entries(tile)} - {"None"}
+            file_lookup = {str(f.pk): f for f in File.objects.filter(pk__in=referenced)}
+            name_lookup = resource_names({str(t.resourceinstance_id): t.resource_name for t in chunk})
+
+            for tile in chunk:
+                resid = str(tile.resourceinstance_id)
+                for node, i in file_entries(tile):
+                    id = str(i['file_id'])
+                    if id == "None":
+                        stats["without_id"] += 1
+                        continue
+                    stats["matched"] += 1
+                    f = file_lookup.get(id)
+                    finfo = lookup_file_info(f, i.get("lastModified"))
+                    yield {
                         "resource id": resid,
-                        "resource name": res.displayname,
-                        "node name": "<unknown>",
+                        "resource name": name_lookup[resid],
+                        "node name": node.name,
                         "file id": id,
-                        "file name (original)": "<unknown>",
+                        "file name (original)": i['name'],
                         "file name (actual)": finfo.get("name", "n/a"),
                         "file path": finfo.get("path", "n/a"),
                         "last modified": finfo.get("last_modified", "n/a")
-                    })
+                    }, f
 
-        print(f"Files in tiles without fileids: {len(files_without_id)}")
-        file_info.sort(key=lambda x: x['resource name'])
-        print(f"Number of files actually referenced in tiles: {matched_total}")
-        print(f"Number of orphaned files: {orphan_total}")
-        return file_info
+        ## orphans come from the same anti-join as --find-orphans, so files
+        ## referenced from other tiles or provisional edits aren't included
+        orphans = FileManager().iterate_orphan_files(files, chunk_size=chunk_size)
+        for batch in chunked(orphans, chunk_size):
+            stats["orphans"] += len(batch)
+            if not include_orphans:
+                continue
+            file_lookup = {str(f.pk): f for f in File.objects.filter(pk__in=[fileid for fileid, path, tileid in batch])}
+            tile_resources = {str(tileid): (str(resid), name) for tileid, resid, name in
+                TileModel.objects.filter(pk__in=[tileid for fileid, path, tileid in batch if tileid])
+                    .annotate(resource_name=resource_name)
+                    .values_list("tileid", "resourceinstance_id", "resource_name")}
+            name_lookup = resource_names(tile_resources.values())
+            for fileid, path, tileid in batch:
+                resid, name = tile_resources.get(str(tileid), ("n/a", None))
+                f = file_lookup.get(fileid)
+                finfo = lookup_file_info(f)
+                yield {
+                    "resource id": resid,
+                    "resource name": name_lookup.get(resid, "n/a"),
+                    "node name": "<unknown>",
+                    "file id": fileid,
+                    "file name (original)": "<unknown>",
+                    "file name (actual)": finfo.get("name", "n/a"),
+                    "file path": finfo.get("path", "n/a"),
+                    "last modified": finfo.get("last_modified", "n/a")
+                }, f
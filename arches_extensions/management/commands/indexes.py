@@ -1,14 +1,170 @@
+import json
+import time
+import uuid
+import queue
+import select
 import logging
+import threading
+import multiprocessing
+from itertools import groupby
+from pathlib import Path
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Count, Max
+from django.utils import timezone
 from django.core.management.base import BaseCommand
 
+from arches.app.models.models import EditLog, Node, ResourceXResource, TileModel
 from arches.app.models.resource import Resource
 from arches.app.models.graph import Graph
-from arches.app.search.search_engine_factory import SearchEngineInstance as se
+from arches.app.search.mappings import (
+    delete_search_index,
+    delete_terms_index,
+    prepare_search_index,
+    prepare_terms_index,
+)
+from arches.app.search.search_engine_factory import SearchEngineFactory, SearchEngineInstance as se
 
-from arches_extensions.utils import ArchesHelpTextFormatter
+from arches_extensions.managers import ResourceIndexManager
+from arches_extensions.utils import (
+    ArchesHelpTextFormatter,
+    MISSING,
+    chunked,
+    get_db_connection,
+    get_graph,
+    get_uuid_ranges,
+    merge_sorted,
+    run_in_processes,
+    user_confirms,
+)
 
 logger = logging.getLogger(__name__)
 
+NOTIFY_CHANNEL = "arches_extensions_index"
+
+NOTIFY_TRIGGERS_SQL = f"""
+CREATE OR REPLACE FUNCTION __arches_extensions_notify_index() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'tiles' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('{NOTIFY_CHANNEL}', OLD.resourceinstanceid::text);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('{NOTIFY_CHANNEL}', NEW.resourceinstanceid::text);
+        END IF;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{NOTIFY_CHANNEL}', OLD.resourceinstanceid::text);
+    ELSE
+        PERFORM pg_notify('{NOTIFY_CHANNEL}', NEW.resourceinstanceid::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS __arches_extensions_notify_index ON tiles;
+CREATE TRIGGER __arches_extensions_notify_index
+    AFTER INSERT OR UPDATE OR DELETE ON tiles
+    FOR EACH ROW EXECUTE PROCEDURE __arches_extensions_notify_index();
+
+DROP TRIGGER IF EXISTS __arches_extensions_notify_index ON resource_instances;
+CREATE TRIGGER __arches_extensions_notify_index
+    AFTER INSERT OR UPDATE OR DELETE ON resource_instances
+    FOR EACH ROW EXECUTE PROCEDURE __arches_extensions_notify_index();
+"""
+
+REMOVE_NOTIFY_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS __arches_extensions_notify_index ON tiles;
+DROP TRIGGER IF EXISTS __arches_extensions_notify_index ON resource_instances;
+DROP FUNCTION IF EXISTS __arches_extensions_notify_index();
+"""
+
+class Differences():
+    """
+    Tallies the differences of each kind found during a check, keeps a few
+    examples of each, and sends the repairs in batches as they are found.
+    `repairs` is a dict of kind: method (or None to only report), where each
+    method takes a list of ids and returns the number repaired and failed.
+    """
+
+    def __init__(self, repairs, flush_size):
+        self.repairs = repairs
+        self.flush_size = flush_size
+        self.counts = Counter()
+        self.examples = {kind: [] for kind in repairs}
+        self.pending = {kind: [] for kind in repairs}
+        self.repaired = {kind: (0, 0) for kind in repairs}
+
+    def found(self, kind, key, *repair_ids):
+        """
+        Records a difference for `key`. The ids passed to the repair method
+        are `repair_ids` if given, otherwise `key` itself.
+        """
+
+        self.counts[kind] += 1
+        if len(self.examples[kind]) < 5:
+            self.examples[kind].append(key)
+        if self.repairs[kind]:
+            self.pending[kind] += repair_ids or [key]
+            if len(self.pending[kind]) >= self.flush_size:
+                self.repair(kind)
+
+    def repair(self, kind):
+
+        ids = list(dict.fromkeys(self.pending[kind]))
+        self.pending[kind] = []
+        if ids:
+            done, failed = self.repairs[kind](ids)
+            self.repaired[kind] = (self.repaired[kind][0] + done, self.repaired[kind][1] + failed)
+
+    def finish(self):
+        """ Sends any repairs that are still pending. """
+
+        for kind in self.pending:
+            if self.repairs[kind]:
+                self.repair(kind)
+
+    def summarize(self, kind, heading, verb, show_empty=False):
+
+        if self.counts[kind] == 0 and not show_empty:
+            return
+        print(heading)
+        [print("    " + i) for i in self.examples[kind]]
+        if self.counts[kind] > 5:
+            print("    ...")
+        if self.repairs[kind] and self.counts[kind]:
+            done, failed = self.repaired[kind]
+            print(f"    {verb}: {done}" + (f", failed: {failed}" if failed else ""))
+
+def run_rebuild_worker(index, messages, stop_event, tasks, batch_size, bulk_workers, report_size):
+    """
+    Entry point for each worker process in a rebuild (see
+    `run_in_processes()`). Takes `(graphid, low, high)` tasks from the
+    `tasks` queue until it gets None, indexes the resources of the graph
+    whose ids fall within the inclusive range, and reports progress and
+    finished tasks through `messages`.
+    """
+
+    ## don't share the parent's Elasticsearch connections with the child
+    se.es = SearchEngineFactory().create().es
+    manager = ResourceIndexManager(batch_size=batch_size, workers=bulk_workers)
+    while not stop_event.is_set():
+        task = tasks.get()
+        if task is None:
+            break
+        graphid, low, high = task
+        resourceids = Resource.objects.filter(graph_id=graphid, pk__range=(low, high)) \
+            .values_list("pk", flat=True).iterator(chunk_size=report_size)
+        for batch in chunked(resourceids, report_size):
+            indexed, errors = manager.index_resources(batch)
+            messages.put(("progress", index, (indexed, errors)))
+            if stop_event.is_set():
+                break
+        else:
+            messages.put(("task", index, task))
+
 class Command(BaseCommand):
     """Some commands for helper operations with the ElasticSearch indexes.
 
@@ -17,12 +173,101 @@ class Command(BaseCommand):
 
     Usage:
 
-        python manage.py indexes [operation] [--index-missing]
+        python manage.py indexes [operation] [--index-missing] [--slices N] [--page-size N]
+            [--batch-size N] [--workers N] [--stale] [--index-stale] [--stale-page-size N] [--prune-orphans]
+            [--incremental] [--checkpoint PATH] [--full-after DAYS]
+            [--graph NAME] [--processes N] [--task-size N] [--recreate] [--restart]
+            [--install-triggers] [--remove-triggers] [--debounce SECONDS] [--max-pending N]
     
     Operations:
 
         - `check`
+        - `check-terms`
+        - `check-relations`
+        - `rebuild`
+        - `follow`
+
+    Each graph is compared as a sorted merge of a database cursor and an
+    index scan, both ordered by resourceinstanceid, so memory use stays flat
+    regardless of the number of resources. The index is read with a point
+    in time and `search_after` pagination, split into `--slices` key ranges
+    that are read concurrently (Elasticsearch 7.12+). Only the fields needed
+    for the comparison are requested from each document, so pages can be
+    large.
+
+    With `--index-missing`, resources that are missing from the index are
+    loaded in batches (with their tiles) and sent to Elasticsearch through
+    the bulk API by `--workers` concurrent requests. Documents that fail are
+    collected in a report in the logs directory instead of ending the run.
+
+    A presence check won't catch a resource whose tiles changed without its
+    document being refreshed. Use `--stale` to also compare a fingerprint of
+    each resource's tiles (ids and data) between the database and its
+    indexed document, and `--index-stale` to reindex the stale resources.
+    The database fingerprints are computed with one aggregate query per
+    graph, but the index scan must fetch tile data, so it is slower, and
+    its pages are much heavier: they use `--stale-page-size` instead of
+    `--page-size`.
+
+    Use `--prune-orphans` to delete all indexed resources that no longer
+    exist in the database (including any indexed under graphs that no
+    longer exist), along with their entries in the `terms` and
+    `resource_relations` indexes, through batched bulk requests.
+
+    Every check saves a small checkpoint file: the latest edit log timestamp
+    at the start of the run, the time of the last full check, and the
+    per-graph resource counts in the database and the index. With
+    `--incremental`, only the resources that were created, edited, or
+    deleted (according to the edit log) since the checkpoint are checked,
+    and then the per-graph counts are compared to catch anything else. A
+    full check is run instead if there is no checkpoint yet or if the last
+    full check is older than `--full-after` days. Note that changes which
+    bypass the edit log (e.g. `bulk-update-tile` in SQL mode) are only
+    caught by a full check.
+
+    `check-terms` compares the `terms` index with the tiles in the database.
+    The term document ids each tile should have are derived from its data
+    (for nodes whose datatype produces search terms), and merged with a scan
+    of the index sorted by tileid. Terms that belong to no tile, or that a
+    tile no longer produces, are bloat and are deleted with `--prune-orphans`.
+    Resources with tiles that are missing terms are reindexed with
+    `--index-missing`.
+
+    `check-relations` compares the `resource_relations` index with the
+    resource relations in the database in the same way. Arches has
+    deprecated this index and no longer writes to it, so this is only useful
+    if something else still reads it. If the index doesn't exist it is only
+    created (with this app's own mapping) with `--index-missing`. Relations
+    missing from the index are indexed with `--index-missing`, and orphaned
+    ones deleted with `--prune-orphans`.
 
+    `rebuild` reindexes every resource (or those of each `--graph`) with a
+    pool of `--processes` worker processes. Each graph is split into
+    contiguous resourceinstanceid ranges of about `--task-size` resources,
+    and each worker takes one range at a time and indexes it in bulk like
+    `--index-missing` does. While it runs, the resources and terms indexes
+    have refreshes turned off and no replicas, and their original settings
+    are restored at the end. Finished ranges are recorded in a checkpoint
+    file (`--rebuild-checkpoint`), so if a rebuild is interrupted, running it
+    again continues with the remaining ranges (use `--restart` to start
+    over). Use `--recreate` to delete and recreate the indexes first, which
+    also drops documents for resources that no longer exist. Relations are
+    not reindexed, use `check-relations` for that.
+
+    `follow` runs until it is stopped, keeping the index in sync with the
+    database as changes are made. Triggers on the `tiles` and
+    `resource_instances` tables (installed with `--install-triggers`, and
+    removed with `--remove-triggers`) send the id of each changed resource
+    through Postgres LISTEN/NOTIFY, which only delivers a transaction's
+    notifications once it commits, and only once per id. Ids are collected
+    until no new ones have arrived for `--debounce` seconds (or a batch is
+    full, or the oldest has waited ten times that long), and then resources
+    that exist are reindexed and those that don't are deleted from the
+    indexes, through bulk requests. Received ids wait in a queue of at most
+    `--max-pending`; when it is full the listener stops reading and further
+    notifications wait in Postgres until the indexing catches up. Changes
+    made while no follower is running are not picked up, so run a `check`
+    after any downtime.
     """
 
     def __init__(self, *args, **kwargs):
@@ -36,9 +281,17 @@ class Command(BaseCommand):
         parser.add_argument("operation",
             choices=[
                 "check",
+                "check-terms",
+                "check-relations",
+                "rebuild",
+                "follow",
             ],
             help="""OPERATION
             check: Compare the current ElasticSearch resource index against the ORM objects and prints a list of missing resources to the logs directory
+            check-terms: Compare the terms index against the tiles in the database
+            check-relations: Compare the (deprecated) resource relations index against the resource relations in the database
+            rebuild: Reindex all resources with a pool of worker processes, resuming an interrupted rebuild
+            follow: Keep the indexes in sync with database changes until stopped
             """
         )
 
@@ -48,96 +301,923 @@ class Command(BaseCommand):
             help="Attempt to index resources that are missing from index."
         )
 
+        parser.add_argument("--stale",
+            action="store_true",
+            default=False,
+            help="Also find indexed resources whose tiles have changed since they were indexed."
+        )
+
+        parser.add_argument("--index-stale",
+            action="store_true",
+            default=False,
+            help="Reindex stale resources (implies --stale)."
+        )
+
+        parser.add_argument("--prune-orphans",
+            action="store_true",
+            default=False,
+            help="Delete indexed resources (and their terms and relations) that are not in the database."
+        )
+
+        parser.add_argument("--incremental",
+            action="store_true",
+            default=False,
+            help="Only check resources changed since the last checkpoint."
+        )
+
+        parser.add_argument("--checkpoint",
+            default=str(Path(Path(settings.APP_ROOT).parent, ".indexes_checkpoint.json")),
+            help="Path to the checkpoint file. Defaults to .indexes_checkpoint.json next to the app directory."
+        )
+
+        parser.add_argument("--full-after",
+            type=float,
+            default=7,
+            help="With --incremental, run a full check if the last one is older than this many days. Default 7."
+        )
+
+        parser.add_argument("--graph",
+            action="append",
+            help="With rebuild, only reindex resources of this graph (name or id). Can be used more than once."
+        )
+
+        parser.add_argument("--processes",
+            type=int,
+            default=4,
+            help="With rebuild, number of worker processes. Default 4."
+        )
+
+        parser.add_argument("--task-size",
+            type=int,
+            default=20000,
+            help="With rebuild, approximate number of resources in each range handed to a worker. Default 20000."
+        )
+
+        parser.add_argument("--recreate",
+            action="store_true",
+            default=False,
+            help="With rebuild, delete and recreate the resources and terms indexes before a new rebuild."
+        )
+
+        parser.add_argument("--restart",
+            action="store_true",
+            default=False,
+            help="With rebuild, ignore the checkpoint of an interrupted rebuild and start over."
+        )
+
+        parser.add_argument("--rebuild-checkpoint",
+            default=str(Path(Path(settings.APP_ROOT).parent, ".indexes_rebuild.json")),
+            help="Path to the rebuild checkpoint file. Defaults to .indexes_rebuild.json next to the app directory."
+        )
+
+        parser.add_argument("--install-triggers",
+            action="store_true",
+            default=False,
+            help="With follow, install the change notification triggers before following."
+        )
+
+        parser.add_argument("--remove-triggers",
+            action="store_true",
+            default=False,
+            help="With follow, remove the change notification triggers and exit."
+        )
+
+        parser.add_argument("--debounce",
+            type=float,
+            default=2,
+            help="With follow, seconds without new changes before a batch is indexed. Default 2."
+        )
+
+        parser.add_argument("--max-pending",
+            type=int,
+            default=10000,
+            help="With follow, maximum number of received changes waiting to be indexed. Default 10000."
+        )
+
+        parser.add_argument("--slices",
+            type=int,
+            default=4,
+            help="Number of slices of the index to read concurrently. Default 4."
+        )
+
+        parser.add_argument("--page-size",
+            type=int,
+            default=5000,
+            help="Number of documents per search request in each slice. Default 5000 (max 10000)."
+        )
+
+        parser.add_argument("--stale-page-size",
+            type=int,
+            default=250,
+            help="Number of documents per search request in each slice when tile data is fetched for --stale. Default 250."
+        )
+
+        parser.add_argument("--batch-size",
+            type=int,
+            default=500,
+            help="Number of resources to load and index per bulk request. Default 500."
+        )
+
+        parser.add_argument("--workers",
+            type=int,
+            default=4,
+            help="Number of concurrent bulk requests when indexing. Default 4."
+        )
+
     def handle(self, *args, **options):
 
+        self.slices = options['slices']
+        self.page_size = options['page_size']
+        self.stale_page_size = options['stale_page_size']
+        self.index_manager = ResourceIndexManager(batch_size=options['batch_size'], workers=options['workers'])
+        ## repairs are sent as differences are found, this many ids at a time
+        self.flush_size = options['batch_size'] * 10
+        self.errors = []
+
         if options['operation'] == "check":
-            self.check(index_missing=options['index-missing'])
+            check_options = dict(
+                index_missing=options['index_missing'],
+                stale=options['stale'] or options['index_stale'],
+                index_stale=options['index_stale'],
+                prune_orphans=options['prune_orphans'],
+            )
+            checkpoint_path = Path(options['checkpoint'])
+            checkpoint = self.load_checkpoint(checkpoint_path)
+            high_water_mark = EditLog.objects.aggregate(Max("timestamp"))["timestamp__max"]
+
+            full = True
+            if options['incremental']:
+                full = self.full_check_due(checkpoint, options['full_after'])
+            if full:
+                graph_counts = self.check(**check_options)
+            else:
+                graph_counts = self.check_incremental(checkpoint, **check_options)
+            self.save_checkpoint(checkpoint_path, checkpoint, high_water_mark, graph_counts, full=full)
 
-    def check(self, index_missing=False):
+        if options['operation'] == "check-terms":
+            self.check_terms(index_missing=options['index_missing'], prune_orphans=options['prune_orphans'])
+
+        if options['operation'] == "check-relations":
+            self.check_relations(index_missing=options['index_missing'], prune_orphans=options['prune_orphans'])
+
+        if options['operation'] == "rebuild":
+            graphs = None
+            if options['graph']:
+                graphs = []
+                for name in options['graph']:
+                    graph = get_graph(name)
+                    if graph is None:
+                        print(f"cancelling, invalid graph: {name}")
+                        exit()
+                    graphs.append(graph)
+            self.rebuild(Path(options['rebuild_checkpoint']),
+                graphs=graphs,
+                processes=options['processes'],
+                task_size=options['task_size'],
+                recreate=options['recreate'],
+                restart=options['restart'],
+                batch_size=options['batch_size'],
+                bulk_workers=options['workers'],
+            )
+
+        if options['operation'] == "follow":
+            if options['remove_triggers']:
+                self.remove_notify_triggers()
+                return
+            if options['install_triggers']:
+                self.install_notify_triggers()
+            self.follow(debounce=options['debounce'], max_pending=options['max_pending'])
+
+        if self.errors:
+            self.write_error_report()
+
+    def check(self, index_missing=False, stale=False, index_stale=False, prune_orphans=False):
         """
         Compare all ES indexes against resources in the ORM (and vice versa).
-        """
 
-        es_contents = self.get_es_contents()
+        Each graph is compared as a sorted merge of two streams, one from a
+        database cursor and one from an index scan, both ordered by
+        resourceinstanceid. Nothing is collected per resource beyond a few
+        examples for the output, and repairs are sent in batches as the
+        differences are found, so memory use stays flat no matter how many
+        resources there are.
+
+        Returns the per-graph counts found, as `get_graph_counts()` does.
+        """
 
         graphs = Graph.objects.filter(isresource=True).exclude(name="Arches System Settings")
 
+        graph_counts = {}
         for graph in graphs:
 
             print(graph.name)
+            graph_counts[str(graph.pk)] = self.check_graph(graph,
+                index_missing=index_missing,
+                stale=stale,
+                index_stale=index_stale,
+                prune_orphans=prune_orphans,
+            )
 
-            missing = []
-            uuid_resids = Resource.objects.filter(graph=graph).values_list('resourceinstanceid', flat=True)
-            db_resourceids = set([str(i) for i in uuid_resids])
-
-            try:
-                es_resourceids = es_contents[str(graph.pk)]
-            except KeyError:
-                es_resourceids = set()
-
-            print(f"- in db: {len(db_resourceids)}")
-            print(f"- in index: {len(es_resourceids)}")
-            if db_resourceids != es_resourceids:
-                es_diff = list(es_resourceids - db_resourceids)
-                if len(es_diff) > 0:
-                    print(f"  {len(es_diff)} indexed resources not in db:")
-                    [print("    " + i) for i in es_diff[:5]]
-                    if len(es_diff) > 5:
-                        print("    ...")
-                db_diff = list(db_resourceids - es_resourceids)
-                if len(db_diff) > 0:
-                    print(f"  {len(db_diff)} db resources not in index:")
-                    [print("    " + i) for i in db_diff[:5]]
-                    if len(db_diff) > 5:
-                        print("    ...")
-                    if index_missing:
-                        print("    indexing these resources now...")
-                        for id in db_diff:
-                            r = Resource.objects.get(pk=id)
-                            try:
-                                r.index()
-                            except Exception as e:
-                                print(e)
-                                break
-
-
-
-    def get_es_contents(self):
-
-        summary = dict()
-        for resinfo in self.iterate_all_documents(se, 'resources'):
-            resid, graphid = resinfo
-            if graphid != 'None':
-                if graphid in summary:
-                    summary[graphid].add(resid)
-                else:
-                    summary[graphid] = set([resid])
-        return summary
-
-    def iterate_all_documents(self, se, index, pagesize=250, scroll_timeout="1m"):
-        """
-        Helper to iterate ALL values from a single index. Yields all the documents.
-        https://techoverflow.net/2019/05/07/elasticsearch-how-to-iterate-scroll-through-all-documents-in-index/
-        """
-        is_first = True
-        while True:
-            # Scroll next
-            if is_first: # Initialize scroll
-                result = se.search(index=index, scroll="1m", body={
-                    "size": pagesize
-                })
-                is_first = False
+        ## documents indexed under graphs that are no longer in the database
+        known_graphids = [str(g.pk) for g in graphs] + [str(settings.SYSTEM_SETTINGS_RESOURCE_MODEL_ID), "None"]
+        query = {"bool": {
+            "filter": [{"exists": {"field": "graph_id"}}],
+            "must_not": [{"terms": {"graph_id": known_graphids}}],
+        }}
+        orphan_counts = Counter()
+        pending, deleted, failed = [], 0, 0
+        for resid, graphid in self.iterate_all_documents(se, 'resources', pagesize=self.page_size,
+                                                         slices=self.slices, query=query):
+            orphan_counts[graphid] += 1
+            if prune_orphans:
+                pending.append(resid)
+                if len(pending) >= self.flush_size:
+                    deleted, failed = self.repair(self.delete_resources, pending, deleted, failed)
+                    pending = []
+        if pending:
+            deleted, failed = self.repair(self.delete_resources, pending, deleted, failed)
+        for graphid, count in orphan_counts.items():
+            print(f"unknown graph {graphid}")
+            print(f"- in index: {count}")
+        if prune_orphans and orphan_counts:
+            print(f"    deleted: {deleted}" + (f", failed: {failed}" if failed else ""))
+        return graph_counts
+
+    def check_graph(self, graph, index_missing=False, stale=False, index_stale=False, prune_orphans=False):
+        """
+        Merge the resources of one graph in the database with those in the
+        index, and print a summary of the differences. Missing, orphaned,
+        and (optionally) stale resources are repaired in batches as they are
+        found, if requested. Returns `{name, db, index}` counts for the graph.
+        """
+
+        db_resources = self.iterate_db_resources(graph, fingerprints=stale)
+        es_resources = self.iterate_indexed_resources(graph, fingerprints=stale)
+        counts = self.compare_resources(merge_sorted(db_resources, es_resources),
+            index_missing=index_missing,
+            stale=stale,
+            index_stale=index_stale,
+            prune_orphans=prune_orphans,
+        )
+        return {"name": str(graph.name), "db": counts["db"], "index": counts["index"]}
+
+    def compare_resources(self, resources, index_missing=False, stale=False, index_stale=False, prune_orphans=False):
+        """
+        Consumes a stream of `(resourceinstanceid, db_value, es_value)`
+        (`MISSING` for the side a resource isn't in, fingerprints or None as
+        values), repairing differences in batches as requested, prints a
+        summary, and returns the counts.
+        """
+
+        differences = Differences({
+            "orphan": self.delete_resources if prune_orphans else None,
+            "missing": self.index_resources if index_missing else None,
+            "stale": self.index_resources if index_stale else None,
+        }, self.flush_size)
+
+        for resid, db_value, es_value in resources:
+            if db_value is not MISSING:
+                differences.counts["db"] += 1
+            if es_value is not MISSING:
+                differences.counts["index"] += 1
+            if es_value is MISSING:
+                differences.found("missing", resid)
+            elif db_value is MISSING:
+                differences.found("orphan", resid)
+            elif stale and db_value != es_value:
+                differences.found("stale", resid)
+        differences.finish()
+
+        counts = differences.counts
+        print(f"- in db: {counts['db']}")
+        print(f"- in index: {counts['index']}")
+        differences.summarize("orphan", f"  {counts['orphan']} indexed resources not in db:", "deleted")
+        differences.summarize("missing", f"  {counts['missing']} db resources not in index:", "indexed")
+        differences.summarize("stale", f"- stale in index: {counts['stale']}", "reindexed", show_empty=stale)
+        return counts
+
+    def check_terms(self, index_missing=False, prune_orphans=False):
+        """
+        Merge the tiles in the database with the terms index, both ordered
+        by tileid, comparing the term document ids of each tile.
+        """
+
+        differences = Differences({
+            "bloat": self.delete_terms if prune_orphans else None,
+            "missing": self.index_resources if index_missing else None,
+        }, self.flush_size)
+
+        print("terms")
+        tiles = merge_sorted(self.iterate_db_tile_terms(), self.iterate_indexed_tile_terms())
+        for tileid, db_value, es_value in tiles:
+            expected, resid = (set(), None) if db_value is MISSING else db_value
+            indexed = set() if es_value is MISSING else es_value
+            differences.counts["db"] += len(expected)
+            differences.counts["index"] += len(indexed)
+            extra = indexed - expected
+            if extra:
+                differences.found("bloat", tileid, *extra)
+            if expected - indexed:
+                differences.found("missing", tileid, resid)
+        differences.finish()
+
+        counts = differences.counts
+        print(f"- expected from db: {counts['db']}")
+        print(f"- in index: {counts['index']}")
+        differences.summarize("bloat", f"  {counts['bloat']} tiles with terms that are not in db:", "deleted")
+        differences.summarize("missing", f"  {counts['missing']} tiles with terms missing from index:", "resources reindexed")
+
+    def iterate_db_tile_terms(self):
+        """
+        Yields `(tileid, (term_ids, resourceinstanceid))` for each tile that
+        should have entries in the terms index, ordered by tileid.
+        """
+
+        manager = self.index_manager
+        term_nodes = manager.get_term_nodes()
+        nodegroupids = set(Node.objects.filter(nodeid__in=term_nodes.keys()).values_list("nodegroup_id", flat=True))
+        tiles = TileModel.objects.filter(nodegroup_id__in=nodegroupids) \
+            .exclude(resourceinstance__graph_id=settings.SYSTEM_SETTINGS_RESOURCE_MODEL_ID) \
+            .order_by("tileid").values_list("tileid", "resourceinstance_id", "data", "provisionaledits") \
+            .iterator(chunk_size=self.page_size)
+        for tileid, resid, data, provisionaledits in tiles:
+            term_ids = manager.get_tile_term_ids(tileid, data, provisionaledits, term_nodes)
+            if term_ids:
+                yield str(tileid), (term_ids, str(resid))
+
+    def iterate_indexed_tile_terms(self):
+        """
+        Yields `(tileid, term_ids)` for each tile in the terms index, ordered
+        by tileid.
+        """
+
+        hits = self.index_manager.scan_sorted('terms', 'tileid',
+            source=["tileid"],
+            pagesize=self.page_size,
+            slices=self.slices,
+        )
+        for tileid, tile_hits in groupby(hits, key=lambda hit: hit['_source']['tileid']):
+            yield tileid, {hit['_id'] for hit in tile_hits}
+
+    def check_relations(self, index_missing=False, prune_orphans=False):
+        """
+        Merge the resource relations in the database with the resource
+        relations index, both ordered by resourcexid.
+        """
+
+        print("note: the resource relations index is deprecated, Arches no longer writes to it")
+        if not se.es.indices.exists(index=self.index_manager.relations_index):
+            if not index_missing:
+                print("resource relations index does not exist, nothing to check. "\
+                      "use --index-missing to create and fill it.")
+                return
+            print("resource relations index does not exist, creating it")
+            self.index_manager.create_relations_index()
+
+        differences = Differences({
+            "orphan": self.delete_relations if prune_orphans else None,
+            "missing": self.index_relations if index_missing else None,
+        }, self.flush_size)
+
+        print("resource relations")
+        relations = merge_sorted(self.iterate_db_relations(), self.iterate_indexed_relations())
+        for relationid, db_value, es_value in relations:
+            if db_value is not MISSING:
+                differences.counts["db"] += 1
+            if es_value is not MISSING:
+                differences.counts["index"] += 1
+            if es_value is MISSING:
+                differences.found("missing", relationid)
+            elif db_value is MISSING:
+                differences.found("orphan", relationid)
+        differences.finish()
+
+        counts = differences.counts
+        print(f"- in db: {counts['db']}")
+        print(f"- in index: {counts['index']}")
+        differences.summarize("orphan", f"  {counts['orphan']} indexed relations not in db:", "deleted")
+        differences.summarize("missing", f"  {counts['missing']} db relations not in index:", "indexed")
+
+    def iterate_db_relations(self):
+
+        relationids = ResourceXResource.objects.order_by("resourcexid") \
+            .values_list("resourcexid", flat=True).iterator(chunk_size=self.page_size)
+        for relationid in relationids:
+            yield str(relationid), None
+
+    def iterate_indexed_relations(self):
+
+        hits = self.index_manager.scan_sorted('resource_relations', 'resourcexid',
+            source=["resourcexid"],
+            pagesize=self.page_size,
+            slices=self.slices,
+        )
+        for hit in hits:
+            yield hit['_source']['resourcexid'], None
+
+    def check_incremental(self, checkpoint, index_missing=False, stale=False, index_stale=False, prune_orphans=False):
+        """
+        Check only the resources in the edit log since the checkpoint, then
+        compare the per-graph counts in the database and the index, and
+        against the counts stored at the last check. Returns the counts.
+        """
+
+        since = checkpoint.get("edit_log_timestamp")
+        print(f"resources edited since {since}")
+        if since is not None:
+            self.compare_resources(self.iterate_edited_resources(datetime.fromisoformat(since), fingerprints=stale),
+                index_missing=index_missing,
+                stale=stale,
+                index_stale=index_stale,
+                prune_orphans=prune_orphans,
+            )
+
+        print("resource counts by graph (change since last check)")
+        previous_counts = checkpoint.get("graph_counts") or {}
+        graph_counts = self.get_graph_counts()
+        drift = False
+        for graphid, counts in graph_counts.items():
+            previous = previous_counts.get(graphid, {"db": 0, "index": 0})
+            flag = ""
+            if counts["db"] != counts["index"]:
+                flag = "  <-- mismatch"
+                drift = True
+            print(f"- {counts['name']}: in db {counts['db']} ({counts['db'] - previous['db']:+}), "
+                  f"in index {counts['index']} ({counts['index'] - previous['index']:+}){flag}")
+        for graphid in previous_counts.keys() - graph_counts.keys():
+            print(f"- graph {graphid} was removed since the last check")
+        if drift:
+            print("counts don't match, changes may have been made outside of the edit log. run a full check.")
+        return graph_counts
+
+    def iterate_edited_resources(self, since, fingerprints=False):
+        """
+        Yields `(resourceinstanceid, db_value, es_value)` like a merged
+        stream, but only for resources with edit log entries after `since`.
+        These are checked a batch at a time, with one query and one
+        multi-get request per batch.
+        """
+
+        resids = EditLog.objects.filter(timestamp__gt=since).order_by() \
+            .values_list("resourceinstanceid", flat=True).distinct().iterator(chunk_size=self.page_size)
+        source = self.index_manager.fingerprint_source if fingerprints else ["resourceinstanceid"]
+        for batch in chunked(resids, self.stale_page_size if fingerprints else self.page_size):
+            batch = [i for i in batch if self.is_uuid(i)]
+            if fingerprints:
+                db_values = dict(self.index_manager.iterate_database_fingerprints(resourceids=batch))
             else:
-                ## note: need to access the ElasticSearch() instance directly
-                ## here, (.es), because the Arches se object doesn't inherit .scroll()
-                result = se.es.scroll(body={
-                    "scroll_id": scroll_id,
-                    "scroll": scroll_timeout
-                })
-            scroll_id = result["_scroll_id"]
-            hits = result["hits"]["hits"]
-            # Stop after no more docs
-            if not hits:
-                break
-            # Yield each entry
-            yield from ((hit['_source']['resourceinstanceid'], hit['_source']['graph_id']) for hit in hits)
+                db_values = {str(i): None for i in Resource.objects.filter(pk__in=batch)
+                    .exclude(graph_id=settings.SYSTEM_SETTINGS_RESOURCE_MODEL_ID).values_list("pk", flat=True)}
+            documents = self.index_manager.get_documents('resources', batch, source=source)
+            for resid in batch:
+                db_value = db_values.get(resid, MISSING)
+                if resid in documents:
+                    es_value = self.index_manager.get_document_fingerprint(documents[resid]) if fingerprints else None
+                else:
+                    es_value = MISSING
+                if db_value is MISSING and es_value is MISSING:
+                    continue
+                yield resid, db_value, es_value
+
+    def is_uuid(self, value):
+
+        try:
+            return str(uuid.UUID(value)) == value
+        except (TypeError, ValueError):
+            return False
+
+    def get_graph_counts(self):
+        """
+        Returns a dict of graph_id: {name, db, index} with the number of
+        resources per graph in the database and in the index, from one
+        aggregate query and one terms aggregation.
+        """
+
+        graphs = Graph.objects.filter(isresource=True).exclude(name="Arches System Settings")
+        counts = {str(g.pk): {"name": str(g.name), "db": 0, "index": 0} for g in graphs}
+        for row in Resource.objects.filter(graph__in=graphs).order_by().values("graph_id").annotate(count=Count("pk")):
+            counts[str(row["graph_id"])]["db"] = row["count"]
+        result = se.es.search(index=se._add_prefix('resources'), body={
+            "size": 0,
+            "aggs": {"graphs": {"terms": {"field": "graph_id", "size": max(len(counts), 1) + 100}}},
+        })
+        for bucket in result["aggregations"]["graphs"]["buckets"]:
+            if bucket["key"] in counts:
+                counts[bucket["key"]]["index"] = bucket["doc_count"]
+        return counts
+
+    def load_checkpoint(self, path):
+
+        if not path.is_file():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def full_check_due(self, checkpoint, full_after):
+        """
+        Returns True if an incremental check should be replaced by a full one.
+        """
+
+        if checkpoint is None or checkpoint.get("last_full_check") is None:
+            print("no checkpoint found, running a full check")
+            return True
+        last_full_check = datetime.fromisoformat(checkpoint["last_full_check"])
+        if timezone.now() - last_full_check > timedelta(days=full_after):
+            print(f"last full check was {last_full_check}, running a full check")
+            return True
+        return False
+
+    def save_checkpoint(self, path, checkpoint, high_water_mark, graph_counts, full=False):
+        """
+        Saves the edit log high-water mark from the start of this run, so
+        that edits made during the run are picked up next time, along with
+        the per-graph counts found by the check, which the next incremental
+        check reports changes against.
+        """
+
+        now = timezone.now()
+        checkpoint = checkpoint or {}
+        checkpoint.update({
+            "edit_log_timestamp": high_water_mark.isoformat() if high_water_mark else checkpoint.get("edit_log_timestamp"),
+            "last_check": now.isoformat(),
+            "last_full_check": now.isoformat() if full else checkpoint.get("last_full_check"),
+            "graph_counts": {graphid: {"db": c["db"], "index": c["index"]} for graphid, c in graph_counts.items()},
+        })
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        print(f"checkpoint saved: {path}")
+
+    def rebuild(self, checkpoint_path, graphs=None, processes=4, task_size=20000, recreate=False,
+                restart=False, batch_size=500, bulk_workers=4):
+        """
+        Reindex resources with a pool of worker processes, recording each
+        finished task in the checkpoint so an interrupted rebuild can resume.
+        """
+
+        previous = self.load_checkpoint(checkpoint_path)
+        checkpoint = None if restart else previous
+        if checkpoint is not None:
+            tasks = [tuple(task) for task in checkpoint["tasks"]]
+            done = set(tuple(task) for task in checkpoint["done"])
+            print(f"resuming rebuild started {checkpoint['started']}: {len(done)} of {len(tasks)} tasks done")
+        else:
+            if recreate:
+                if not user_confirms("delete and recreate the resources and terms indexes?", default=False):
+                    print("cancelled")
+                    exit()
+                delete_search_index()
+                delete_terms_index()
+                prepare_search_index(create=True)
+                prepare_terms_index(create=True)
+            if graphs is None:
+                graphs = Graph.objects.filter(isresource=True).exclude(name="Arches System Settings")
+            tasks, done = [], set()
+            for graph in graphs:
+                graph_tasks = self.get_rebuild_tasks(graph, task_size)
+                print(f"{graph.name}: {sum(count for task, count in graph_tasks)} resources in {len(graph_tasks)} tasks")
+                tasks += [task for task, count in graph_tasks]
+            checkpoint = {
+                "started": timezone.now().isoformat(),
+                "tasks": tasks,
+                "done": [],
+                ## an interrupted run leaves refreshes off, so keep the settings
+                ## it saved as the ones to restore
+                "index_settings": previous["index_settings"] if previous else self.get_index_settings(),
+            }
+            self.write_rebuild_checkpoint(checkpoint_path, checkpoint, done)
+
+        def task_done(task):
+            done.add(task)
+            self.write_rebuild_checkpoint(checkpoint_path, checkpoint, done)
+
+        remaining = [task for task in tasks if task not in done]
+        self.set_index_settings({index: {"refresh_interval": "-1", "number_of_replicas": 0}
+                                 for index in checkpoint["index_settings"]})
+        try:
+            failed = self.rebuild_in_workers(remaining, processes, batch_size, bulk_workers, on_task=task_done)
+        finally:
+            print("restoring index settings")
+            self.set_index_settings(checkpoint["index_settings"])
+            for index in checkpoint["index_settings"]:
+                se.es.indices.refresh(index=index)
+
+        if failed:
+            print(f"rebuild stopped with {len(tasks) - len(done)} of {len(tasks)} tasks left. "\
+                  f"rerun this command to continue, progress is saved in {checkpoint_path}")
+            exit(1)
+        checkpoint_path.unlink()
+        print("rebuild complete")
+
+    def rebuild_in_workers(self, tasks, processes, batch_size, bulk_workers, on_task):
+        """
+        Runs `run_rebuild_worker()` in `processes` worker processes that share
+        one queue of tasks, calling `on_task` for each finished task and
+        printing the indexing rate of each worker. Returns True if the
+        rebuild was stopped by an error or an interruption.
+        """
+
+        task_queue = multiprocessing.get_context("fork").Queue()
+        ## tasks left over after a failure must not block this process at exit
+        task_queue.cancel_join_thread()
+        for task in tasks:
+            task_queue.put(task)
+        for n in range(processes):
+            task_queue.put(None)
+
+        indexed = [0] * processes
+        def report(status, index, payload):
+            if status == "progress":
+                indexed[index] += payload[0]
+                self.errors += payload[1]
+                self.print_rebuild_progress(indexed, start, end="\r")
+            elif status == "task":
+                on_task(tuple(payload))
+
+        start = time.monotonic()
+        errors = run_in_processes(run_rebuild_worker,
+            [(task_queue, batch_size, bulk_workers, self.flush_size)] * processes,
+            on_message=report,
+        )
+
+        self.print_rebuild_progress(indexed, start)
+        for n, count in enumerate(indexed):
+            print(f"  worker {n}: {count} resources ({count / max(time.monotonic() - start, 0.001):.0f} docs/sec)")
+        for index, error in errors.items():
+            print(f"  worker {index}:" if index != "main" else "  stopped:")
+            print("    " + error.strip().replace("\n", "\n    "))
+        return bool(errors)
+
+    def print_rebuild_progress(self, indexed, start, end="\n"):
+
+        elapsed = max(time.monotonic() - start, 0.001)
+        rates = " ".join(f"{count / elapsed:.0f}" for count in indexed)
+        print(f"  resources indexed: {sum(indexed)} in {elapsed:.1f}s "\
+              f"({sum(indexed) / elapsed:.0f} docs/sec, per worker: {rates})", end=end)
+
+    def get_rebuild_tasks(self, graph, task_size):
+        """
+        Splits the resources of `graph` into contiguous, non-overlapping
+        resourceinstanceid ranges of about `task_size` resources each.
+        Returns a list of `((graphid, low, high), count)` with inclusive
+        bounds.
+        """
+
+        resources = Resource.objects.filter(graph=graph)
+        count = resources.count()
+        if count == 0:
+            return []
+        ranges = get_uuid_ranges(resources.values_list("pk"), -(-count // task_size))
+        return [((str(graph.pk), low, high), n) for low, high, n in ranges]
+
+    def get_index_settings(self):
+        """
+        Returns the current refresh interval and number of replicas of the
+        resources and terms indexes, as a dict of index: settings. A refresh
+        interval that was never set is None, which restores the default.
+        """
+
+        index_settings = {}
+        for index in [self.index_manager.resources_index, self.index_manager.terms_index]:
+            response = se.es.indices.get_settings(index=index)
+            current = next(iter(response.values()))["settings"]["index"]
+            index_settings[index] = {
+                "refresh_interval": current.get("refresh_interval"),
+                "number_of_replicas": current.get("number_of_replicas"),
+            }
+        return index_settings
+
+    def set_index_settings(self, index_settings):
+
+        for index, values in index_settings.items():
+            se.es.indices.put_settings(index=index, body={"index": values})
+
+    def write_rebuild_checkpoint(self, path, checkpoint, done):
+
+        checkpoint["done"] = [task for task in checkpoint["tasks"] if tuple(task) in done]
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "w") as f:
+            json.dump(checkpoint, f, indent=2)
+
+    def install_notify_triggers(self):
+
+        with connection.cursor() as cursor:
+            cursor.execute(NOTIFY_TRIGGERS_SQL)
+        print("change notification triggers installed")
+
+    def remove_notify_triggers(self):
+
+        with connection.cursor() as cursor:
+            cursor.execute(REMOVE_NOTIFY_TRIGGERS_SQL)
+        print("change notification triggers removed")
+
+    def notify_triggers_installed(self):
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_trigger WHERE tgname = '__arches_extensions_notify_index'")
+            return cursor.fetchone()[0] == 2
+
+    def listen(self, changes, stop, failure):
+        """
+        Runs in a thread, reading notifications on a dedicated connection and
+        putting the resource ids into the `changes` queue. Blocks while the
+        queue is full, which leaves further notifications waiting in
+        Postgres. Any exception is stored in `failure` and ends the thread.
+        """
+
+        try:
+            conn = get_db_connection()
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL};")
+            while not stop.is_set():
+                if select.select([conn], [], [], 1) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies and not stop.is_set():
+                    resid = conn.notifies.pop(0).payload
+                    while not stop.is_set():
+                        try:
+                            changes.put(resid, timeout=1)
+                            break
+                        except queue.Full:
+                            continue
+            conn.close()
+        except Exception as e:
+            failure.append(e)
+
+    def follow(self, debounce=2, max_pending=10000):
+        """
+        Listen for changed resource ids and sync them to the index in
+        debounced batches until interrupted.
+        """
+
+        if not self.notify_triggers_installed():
+            print("change notification triggers are not installed, use --install-triggers")
+            exit(1)
+
+        changes = queue.Queue(maxsize=max_pending)
+        stop = threading.Event()
+        failure = []
+        listener = threading.Thread(target=self.listen, args=(changes, stop, failure), daemon=True)
+        listener.start()
+        print(f"following changes (debounce {debounce}s), press Ctrl+C to stop")
+
+        pending = set()
+        first_change, last_change = None, None
+        try:
+            while listener.is_alive():
+                try:
+                    resid = changes.get(timeout=min(debounce, 1))
+                    now = time.monotonic()
+                    if not pending:
+                        first_change = now
+                    pending.add(resid)
+                    last_change = now
+                except queue.Empty:
+                    now = time.monotonic()
+                if pending and (len(pending) >= self.flush_size or now - last_change >= debounce
+                                or now - first_change >= debounce * 10):
+                    if self.sync_resources(pending):
+                        pending = set()
+                    else:
+                        ## leave the ids pending and wait before trying again
+                        time.sleep(debounce)
+        except KeyboardInterrupt:
+            print("stopping")
+        finally:
+            stop.set()
+            listener.join()
+        if pending:
+            self.sync_resources(pending)
+        if failure:
+            print(f"listener failed: {failure[0]!r}")
+            exit(1)
+
+    def sync_resources(self, resourceids):
+        """
+        Reindexes the given resources that exist and deletes the rest from
+        the indexes. Returns False if the batch couldn't be processed (e.g.
+        Elasticsearch or the database is unavailable) so it can be retried.
+        """
+
+        try:
+            close_old_connections()
+            resourceids = [i for i in resourceids if self.is_uuid(i)]
+            existing = {str(i) for i in Resource.objects.filter(pk__in=resourceids)
+                .exclude(graph_id=settings.SYSTEM_SETTINGS_RESOURCE_MODEL_ID).values_list("pk", flat=True)}
+            deleted = [i for i in resourceids if i not in existing]
+            indexed, index_errors = self.index_manager.index_resources(existing) if existing else (0, [])
+            removed, delete_errors = self.index_manager.delete_resources(deleted) if deleted else (0, [])
+        except Exception as e:
+            logger.exception("index sync failed")
+            print(f"sync failed, retrying: {e!r}")
+            return False
+        failed = len(index_errors) + len(delete_errors)
+        print(f"{datetime.now():%Y-%m-%d %H:%M:%S} indexed: {indexed}, deleted: {removed}" \
+              + (f", failed: {failed}" if failed else ""))
+        return True
+
+    def iterate_db_resources(self, graph, fingerprints=False):
+        """
+        Yields `(resourceinstanceid, fingerprint)` for each resource of the
+        graph in the database, ordered by resourceinstanceid. Fingerprints
+        are None unless requested.
+        """
+
+        if fingerprints:
+            yield from self.index_manager.iterate_database_fingerprints(graph.pk, chunk_size=self.page_size)
+        else:
+            resids = Resource.objects.filter(graph=graph).order_by('resourceinstanceid') \
+                .values_list('resourceinstanceid', flat=True).iterator(chunk_size=self.page_size)
+            for resid in resids:
+                yield str(resid), None
+
+    def iterate_indexed_resources(self, graph, fingerprints=False):
+        """
+        Yields `(resourceinstanceid, fingerprint)` for each indexed resource
+        of the graph, ordered by resourceinstanceid. Fingerprints are None
+        unless requested. See `ResourceIndexManager.scan_sorted()`.
+        """
+
+        manager = self.index_manager
+        source = manager.fingerprint_source if fingerprints else ["resourceinstanceid"]
+        hits = manager.scan_sorted('resources', 'resourceinstanceid',
+            query={"term": {"graph_id": str(graph.pk)}},
+            source=source,
+            pagesize=self.stale_page_size if fingerprints else self.page_size,
+            slices=self.slices,
+        )
+        for hit in hits:
+            fingerprint = manager.get_document_fingerprint(hit['_source']) if fingerprints else None
+            yield hit['_source']['resourceinstanceid'], fingerprint
+
+    def repair(self, method, resourceids, done=0, failed=0):
+        """
+        Runs `index_resources()` or `delete_resources()` for a batch of ids,
+        and adds the results to the running `done` and `failed` totals.
+        """
+
+        batch_done, batch_failed = method(resourceids)
+        return done + batch_done, failed + batch_failed
+
+    def index_resources(self, resourceids):
+        """
+        Bulk index the given resources, collecting any failed documents in
+        `self.errors` for the report. Returns the number of resources
+        indexed and the number of failed documents.
+        """
+
+        indexed, errors = self.index_manager.index_resources(resourceids)
+        self.errors += errors
+        return indexed, len(errors)
+
+    def delete_resources(self, resourceids):
+        """
+        Bulk delete the given resources from the indexes, collecting any
+        failures in `self.errors` for the report. Returns the number of
+        resources deleted and the number of failures.
+        """
+
+        deleted, errors = self.index_manager.delete_resources(resourceids)
+        self.errors += errors
+        return deleted, len(errors)
+
+    def delete_terms(self, termids):
+
+        deleted, errors = self.index_manager.delete_documents('terms', termids)
+        self.errors += errors
+        return deleted, len(errors)
+
+    def index_relations(self, relationids):
+
+        indexed, errors = self.index_manager.index_relations(relationids)
+        self.errors += errors
+        return indexed, len(errors)
+
+    def delete_relations(self, relationids):
+
+        deleted, errors = self.index_manager.delete_documents('resource_relations', relationids)
+        self.errors += errors
+        return deleted, len(errors)
+
+    def write_error_report(self):
+
+        log_dir = Path(settings.LOG_DIR)
+        log_dir.mkdir(exist_ok=True, parents=True)
+        report = Path(log_dir, datetime.now().strftime("indexes_errors__%Y%m%d-%H%M%S.jsonl"))
+        with open(report, "w") as o:
+            for error in self.errors:
+                o.write(json.dumps(error, default=str) + "\n")
+        print(f"{len(self.errors)} documents failed, see: {report}")
+
+    def iterate_all_documents(self, se, index, pagesize=5000, slices=4, query=None):
+        """
+        Helper to iterate ALL values from a single index (or those matching
+        `query`). Yields the resourceinstanceid and graph_id of each
+        document, in no particular order. Only those two fields are fetched
+        from the `_source` of each document. See `ResourceIndexManager.scan()`.
+        """
+        source = ["resourceinstanceid", "graph_id"]
+        for hit in self.index_manager.scan(index, query=query, source=source, pagesize=pagesize, slices=slices):
+            yield hit['_source']['resourceinstanceid'], hit['_source']['graph_id']
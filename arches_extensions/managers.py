@@ -2,14 +2,29 @@ import os
 import imp
 import json
 import uuid
+import queue
+import hashlib
 import logging
+import threading
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 
-from django.db import transaction
+from django.conf import settings
+from django.db import connection, transaction
 from django.contrib.gis.db.models import UUIDField
+from django.forms.models import model_to_dict
+from elasticsearch.helpers import parallel_bulk
 
 from arches.app.models import models
+from arches.app.models.resource import Resource
+from arches.app.datatypes.base import BaseDataType
+from arches.app.datatypes.datatypes import DataTypeFactory
+from arches.app.search.mappings import RESOURCES_INDEX, RESOURCE_RELATIONS_INDEX, TERMS_INDEX
+from arches.app.search.search_engine_factory import SearchEngineInstance as se
+from arches.app.utils.betterJSONSerializer import JSONSerializer
+from arches.app.utils import import_class_from_string
 
-from arches_extensions.utils import ArchesCLIStyles
+from arches_extensions.utils import ArchesCLIStyles, chunked
 
 logger = logging.getLogger(__name__)
 
@@ -171,4 +186,598 @@ class ExtensionManager():
             print(f"---\nregistered {self.extension_type} count: {instances.count()}")
         except Exception as e:
             print(s.error(e))
-            raise e
\ No newline at end of file
+            raise e
+
+class ResourceIndexManager():
+    """ A manager class for bulk reads and writes of resource documents in the Elasticsearch indexes.
+
+    Usage::
+
+        manager = ResourceIndexManager(batch_size=500, workers=4)
+        indexed, errors = manager.index_resources(resourceids)
+        for hit in manager.scan("resources", slices=4, pagesize=1000):
+            ...
+    """
+    def __init__(self, batch_size=500, workers=4):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.resources_index = se._add_prefix(RESOURCES_INDEX)
+        self.terms_index = se._add_prefix(TERMS_INDEX)
+        self.relations_index = se._add_prefix(RESOURCE_RELATIONS_INDEX)
+
+    def _bulk(self, actions, errors):
+        """
+        Sends the actions through the bulk API with `workers` requests in
+        flight at once. Yields the result of each successful operation and
+        appends failed ones to `errors`.
+        """
+
+        for ok, info in parallel_bulk(se.es, actions,
+                                      thread_count=self.workers,
+                                      chunk_size=self.batch_size,
+                                      raise_on_error=False,
+                                      raise_on_exception=False):
+            op = next(iter(info.values()))
+            if ok:
+                yield op
+            else:
+                errors.append({
+                    "id": op.get("_id"),
+                    "index": op.get("_index"),
+                    "status": op.get("status"),
+                    "error": op.get("error", op.get("exception", op.get("result"))),
+                })
+
+    def _iterate_index_actions(self, resourceids, errors):
+
+        datatype_factory = DataTypeFactory()
+        node_datatypes = {str(nodeid): datatype for nodeid, datatype in
+                          models.Node.objects.values_list("nodeid", "datatype")}
+        root_ontology_classes = {str(graphid): ontologyclass for graphid, ontologyclass in
+                                 models.Node.objects.filter(istopnode=True).values_list("graph_id", "ontologyclass")}
+        custom_indexes = [import_class_from_string(index["module"])(index["name"])
+                          for index in settings.ELASTICSEARCH_CUSTOM_INDEXES]
+        serializer = JSONSerializer()
+
+        for batch in chunked(resourceids, self.batch_size):
+
+            ## load the resources and all of their tiles with two queries, instead
+            ## of letting each resource fetch its own tiles during indexing
+            resources = Resource.objects.filter(pk__in=batch)
+            tiles = {}
+            for tile in models.TileModel.objects.filter(resourceinstance_id__in=batch):
+                tiles.setdefault(str(tile.resourceinstance_id), []).append(tile)
+
+            found = set()
+            actions = []
+            for resource in resources:
+                found.add(str(resource.pk))
+                if str(resource.graph_id) == str(settings.SYSTEM_SETTINGS_RESOURCE_MODEL_ID):
+                    continue
+                resource.tiles = tiles.get(str(resource.pk), [])
+                try:
+                    document, terms = resource.get_documents_to_index(
+                        fetchTiles=False,
+                        datatype_factory=datatype_factory,
+                        node_datatypes=node_datatypes,
+                    )
+                    ## the same documents Resource.index() adds to each custom index
+                    custom_documents = [(index, *index.get_documents_to_index(resource, document["tiles"]))
+                                        for index in custom_indexes]
+                except Exception as e:
+                    errors.append({"id": str(resource.pk), "index": self.resources_index, "error": repr(e)})
+                    continue
+                document["root_ontology_class"] = root_ontology_classes.get(str(resource.graph_id))
+                actions.append({
+                    "_index": self.resources_index,
+                    "_id": str(resource.pk),
+                    "_source": serializer.serializeToPython(document),
+                })
+                for term in terms:
+                    actions.append({
+                        "_index": self.terms_index,
+                        "_id": term["_id"],
+                        "_source": serializer.serializeToPython(term["_source"]),
+                    })
+                for index, custom_document, custom_id in custom_documents:
+                    if custom_document is not None:
+                        actions.append({
+                            "_index": se._add_prefix(index.index_name),
+                            "_id": str(custom_id),
+                            "_source": serializer.serializeToPython(custom_document),
+                        })
+
+            for resourceid in set(str(i) for i in batch) - found:
+                errors.append({"id": resourceid, "index": self.resources_index, "error": "resource does not exist"})
+
+            ## term ids depend on the tile data, so a resource's old terms are
+            ## removed first, or terms for values that are gone would remain
+            indexed_ids = [action["_id"] for action in actions if action["_index"] == self.resources_index]
+            if indexed_ids:
+                try:
+                    se.es.delete_by_query(index=self.terms_index, conflicts="proceed", ignore_unavailable=True,
+                                          body={"query": {"terms": {"resourceinstanceid": indexed_ids}}})
+                except Exception as e:
+                    errors += [{"id": i, "index": self.terms_index, "error": repr(e)} for i in indexed_ids]
+            yield from actions
+
+        ## this generator may be consumed in one of the bulk helper's threads,
+        ## which would otherwise leave its own database connection open
+        connection.close()
+
+    def index_resources(self, resourceids):
+        """
+        Indexes the given resources (and their terms, and any documents for
+        the `ELASTICSEARCH_CUSTOM_INDEXES`) in batches. For each batch the
+        resources and all of their tiles are loaded with two queries, the
+        batch's old terms are deleted, and the documents are sent to
+        Elasticsearch through the bulk API with `workers` bulk requests in
+        flight at once.
+
+        A document that fails to build or index doesn't stop the run. Returns
+        the number of resources indexed, and a list of errors with the `id`
+        and `index` of each failed document.
+        """
+
+        indexed, errors = 0, []
+        actions = self._iterate_index_actions(resourceids, errors)
+        for op in self._bulk(actions, errors):
+            if op.get("_index") == self.resources_index:
+                indexed += 1
+        for error in errors:
+            logger.error(f"failed to index {error['index']} document {error['id']}: {error['error']}")
+        return indexed, errors
+
+    def delete_resources(self, resourceids):
+        """
+        Deletes the documents for the given resources from the resources
+        index through the bulk API, and then removes their entries from the
+        terms and resource relations indexes with one delete-by-query per
+        batch of ids. Returns the number of resource documents deleted, and a
+        list of errors like `index_resources()`.
+        """
+
+        deleted, errors = self.delete_documents(RESOURCES_INDEX, resourceids)
+
+        for batch in chunked([str(i) for i in resourceids], self.batch_size):
+            related = [
+                (self.terms_index, {"terms": {"resourceinstanceid": batch}}),
+                (self.relations_index, {"bool": {"should": [
+                    {"terms": {"resourceinstanceidfrom": batch}},
+                    {"terms": {"resourceinstanceidto": batch}},
+                ]}}),
+            ]
+            for index, query in related:
+                try:
+                    se.es.delete_by_query(index=index, body={"query": query}, conflicts="proceed",
+                                          ignore_unavailable=True)
+                except Exception as e:
+                    errors += [{"id": i, "index": index, "error": repr(e)} for i in batch]
+        for error in errors:
+            logger.error(f"failed to delete {error['index']} document {error['id']}: {error['error']}")
+        return deleted, errors
+
+    def delete_documents(self, index, ids):
+        """
+        Deletes the documents with the given ids from `index` through the
+        bulk API. Documents that are already gone are not errors. Returns the
+        number of documents deleted, and a list of errors like
+        `index_resources()`.
+        """
+
+        deleted, errors = 0, []
+        actions = ({"_op_type": "delete", "_index": se._add_prefix(index), "_id": str(i)} for i in ids)
+        for op in self._bulk(actions, errors):
+            deleted += 1
+        errors = [e for e in errors if e.get("status") != 404]
+        return deleted, errors
+
+    ## Arches deprecated the resource relations index (it is no longer
+    ## written by ResourceXResource.save(), and recent versions don't have a
+    ## function to create it), so this is the mapping it used to have, for
+    ## the relation fields as `model_to_dict()` serializes them
+    relations_index_body = {
+        "mappings": {
+            "properties": {
+                "resourcexid": {"type": "keyword"},
+                "notes": {"type": "text"},
+                "relationshiptype": {"type": "keyword"},
+                "inverserelationshiptype": {"type": "keyword"},
+                "resourceinstanceidfrom": {"type": "keyword"},
+                "resourceinstanceidto": {"type": "keyword"},
+                "created": {"type": "keyword"},
+                "modified": {"type": "keyword"},
+            }
+        }
+    }
+
+    def create_relations_index(self):
+        """ Creates the resource relations index with `relations_index_body`. """
+
+        se.create_index(index=RESOURCE_RELATIONS_INDEX, body=self.relations_index_body)
+
+    def index_relations(self, resourcexids):
+        """
+        Indexes the given resource relations (`ResourceXResource` ids) in
+        the deprecated resource relations index, as the model fields
+        serialized by `model_to_dict()`, loading and sending them in
+        batches. Returns the number of relations indexed, and a list of
+        errors like `index_resources()`.
+        """
+
+        def actions():
+            for batch in chunked(resourcexids, self.batch_size):
+                for relation in models.ResourceXResource.objects.filter(pk__in=batch):
+                    yield {
+                        "_index": self.relations_index,
+                        "_id": str(relation.pk),
+                        "_source": JSONSerializer().serializeToPython(model_to_dict(relation)),
+                    }
+            connection.close()
+
+        indexed, errors = 0, []
+        for op in self._bulk(actions(), errors):
+            indexed += 1
+        for error in errors:
+            logger.error(f"failed to index {error['index']} document {error['id']}: {error['error']}")
+        return indexed, errors
+
+    def get_term_nodes(self):
+        """
+        Returns a dict of nodeid: datatype instance for every node whose
+        datatype adds entries to the terms index, i.e. whose datatype class
+        overrides `get_search_terms()`.
+        """
+
+        datatype_factory = DataTypeFactory()
+        term_nodes = {}
+        for nodeid, datatype in models.Node.objects.exclude(datatype="semantic").values_list("nodeid", "datatype"):
+            try:
+                instance = datatype_factory.get_instance(datatype)
+            except Exception:
+                continue
+            if type(instance).get_search_terms is not BaseDataType.get_search_terms:
+                term_nodes[str(nodeid)] = instance
+        return term_nodes
+
+    def get_tile_term_ids(self, tileid, data, provisionaledits, term_nodes):
+        """
+        Returns the set of terms index document ids that a tile should have,
+        built the same way as in `Resource.get_documents_to_index()`, from
+        the tile's data and any provisional edits under review.
+        """
+
+        values = [data or {}]
+        for edit in (provisionaledits or {}).values():
+            if edit.get("status") == "review":
+                values.append(edit.get("value") or {})
+        ids = set()
+        for value in values:
+            for nodeid, nodevalue in value.items():
+                if nodeid not in term_nodes or nodevalue in ("", [], {}, None):
+                    continue
+                for index, term in enumerate(term_nodes[nodeid].get_search_terms(nodevalue, nodeid)):
+                    ids.add(f"{nodeid}{tileid}{index}{getattr(term, 'lang', '')}")
+        return ids
+
+    ## fingerprints are compared between the database and the index to find
+    ## stale documents. both sides hash each tile's data as Postgres prints
+    ## it (jsonb::text), so the Python side must reproduce that format.
+    fingerprint_source = ["resourceinstanceid", "graph_id", "tiles.tileid", "tiles.data"]
+
+    def iterate_database_fingerprints(self, graphid=None, resourceids=None, chunk_size=5000):
+        """
+        Yields `(resourceinstanceid, fingerprint)` for every resource in the
+        graph (or for each of the given `resourceids` that exists and is
+        indexable), ordered by resourceinstanceid, from a single aggregate
+        query read through a server-side cursor. The fingerprint is an md5
+        hash over the ordered tile ids and a hash of each tile's data, so it
+        changes whenever a tile is added, removed, or edited.
+        """
+
+        if graphid is not None:
+            where, params = "r.graphid = %s", [graphid]
+        else:
+            where = "r.resourceinstanceid = ANY(%s::uuid[]) AND r.graphid != %s"
+            params = [[str(i) for i in resourceids], settings.SYSTEM_SETTINGS_RESOURCE_MODEL_ID]
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT r.resourceinstanceid::text, md5(COALESCE(string_agg(
+                    t.tileid::text || ':' || md5(COALESCE(t.tiledata, '{{}}'::jsonb)::text),
+                    ',' ORDER BY t.tileid
+                ), ''))
+                FROM resource_instances r
+                LEFT JOIN tiles t ON t.resourceinstanceid = r.resourceinstanceid
+                WHERE {where}
+                GROUP BY r.resourceinstanceid
+                ORDER BY r.resourceinstanceid
+            """, params)
+            while rows := cursor.fetchmany(chunk_size):
+                yield from rows
+
+    def get_document_fingerprint(self, source):
+        """
+        Returns the fingerprint for an indexed resource document (which must
+        include `tiles.tileid` and `tiles.data`), in the same form as
+        `iterate_database_fingerprints()`. Source filtering drops an empty
+        `tiles` list from the document, so a missing field counts as no
+        tiles, matching the database side's `md5('')`. Number formatting can
+        differ slightly from Postgres in rare cases, which only means an
+        unnecessary reindex.
+        """
+
+        tiles = sorted(source.get("tiles") or [], key=lambda tile: str(tile["tileid"]))
+        parts = []
+        for tile in tiles:
+            data_hash = hashlib.md5(self._jsonb_text(tile.get("data") or {}).encode()).hexdigest()
+            parts.append(f"{tile['tileid']}:{data_hash}")
+        return hashlib.md5(",".join(parts).encode()).hexdigest()
+
+    def get_documents(self, index, ids, source=None):
+        """
+        Returns a dict of id: `_source` for those of the given ids that are
+        in `index`, fetched with a single multi-get request.
+        """
+
+        if not ids:
+            return {}
+        docs = [{"_id": str(i), "_source": source if source is not None else True} for i in ids]
+        result = se.es.mget(index=se._add_prefix(index), body={"docs": docs})
+        return {doc["_id"]: doc.get("_source", {}) for doc in result["docs"] if doc.get("found")}
+
+    def _jsonb_text(self, value):
+        """ Serializes a value the way Postgres prints jsonb. """
+
+        if value is None:
+            return "null"
+        if value is True:
+            return "true"
+        if value is False:
+            return "false"
+        if isinstance(value, int):
+            return str(value)
+        if isinstance(value, float):
+            return format(Decimal(repr(value)), "f")
+        if isinstance(value, str):
+            escaped = []
+            for char in value:
+                if char in '"\\':
+                    escaped.append("\\" + char)
+                elif char in "\b\f\n\r\t":
+                    escaped.append({"\b": "\\b", "\f": "\\f", "\n": "\\n", "\r": "\\r", "\t": "\\t"}[char])
+                elif ord(char) < 32:
+                    escaped.append(f"\\u{ord(char):04x}")
+                else:
+                    escaped.append(char)
+            return '"' + "".join(escaped) + '"'
+        if isinstance(value, list):
+            return "[" + ", ".join(self._jsonb_text(i) for i in value) + "]"
+        if isinstance(value, dict):
+            ## jsonb stores object keys ordered by length, then bytewise
+            keys = sorted(value.keys(), key=lambda k: (len(k.encode()), k.encode()))
+            return "{" + ", ".join(f"{self._jsonb_text(k)}: {self._jsonb_text(value[k])}" for k in keys) + "}"
+        return self._jsonb_text(str(value))
+
+    _pages_done = object()
+
+    def _read_pages(self, body, pages, stop, keep_alive="5m"):
+        """
+        Runs one point in time search with `search_after` pagination (`body`
+        must contain the `pit` and `sort`), and puts each page of hits into
+        the `pages` queue, followed by `_pages_done` or the exception that
+        stopped it. Gives up as soon as `stop` is set.
+        """
+
+        def put(item):
+            ## don't block forever if the consumer has gone away
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            body = dict(body)
+            while not stop.is_set():
+                result = se.es.search(body=body)
+                body["pit"] = {"id": result.get("pit_id", body["pit"]["id"]), "keep_alive": keep_alive}
+                hits = result["hits"]["hits"]
+                if not hits or not put(hits):
+                    break
+                body["search_after"] = hits[-1]["sort"]
+            put(self._pages_done)
+        except Exception as e:
+            put(e)
+
+    def _yield_pages(self, pages):
+        """ Yields hits from the `pages` queue until one reader is done. """
+
+        while True:
+            item = pages.get()
+            if item is self._pages_done:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            yield from item
+
+    def _search_body(self, pit_id, sort, query=None, source=None, pagesize=1000, keep_alive="5m"):
+
+        body = {
+            "pit": {"id": pit_id, "keep_alive": keep_alive},
+            "size": pagesize,
+            "sort": sort,
+            "track_total_hits": False,
+        }
+        if query is not None:
+            body["query"] = query
+        if source is not None:
+            body["_source"] = source
+        return body
+
+    def scan(self, index, query=None, source=None, pagesize=1000, slices=4, keep_alive="5m"):
+        """
+        Yields every hit in `index` (optionally matching `query`, and with
+        `_source` filtered by `source`). The index is read from a point in
+        time with `search_after` pagination, split into `slices` that are
+        read concurrently, so hits are yielded in no particular order.
+        Requires Elasticsearch 7.12+.
+        """
+
+        pit_id = se.es.open_point_in_time(index=se._add_prefix(index), keep_alive=keep_alive)["id"]
+        pages = queue.Queue(maxsize=slices * 2)
+        stop = threading.Event()
+        try:
+            with ThreadPoolExecutor(max_workers=slices) as executor:
+                for slice_id in range(slices):
+                    body = self._search_body(pit_id, ["_shard_doc"], query, source, pagesize, keep_alive)
+                    if slices > 1:
+                        body["slice"] = {"id": slice_id, "max": slices}
+                    executor.submit(self._read_pages, body, pages, stop, keep_alive)
+                try:
+                    for slice_id in range(slices):
+                        yield from self._yield_pages(pages)
+                finally:
+                    stop.set()
+        finally:
+            se.es.close_point_in_time(body={"id": pit_id})
+
+    def scan_sorted(self, index, sort_field, query=None, source=None, pagesize=1000, slices=4, keep_alive="5m"):
+        """
+        Yields every hit in `index` like `scan()`, but ordered by
+        `sort_field`, which must be a keyword field holding uuids (e.g.
+        `resourceinstanceid`). The uuid key space is split into `slices`
+        contiguous ranges that are read concurrently ahead of the consumer
+        and yielded in order, so no more than two pages per range are held
+        in memory at once.
+        """
+
+        bounds = [None] + [format(n * 0x10000 // slices, "04x") for n in range(1, slices)] + [None]
+        pit_id = se.es.open_point_in_time(index=se._add_prefix(index), keep_alive=keep_alive)["id"]
+        range_pages = [queue.Queue(maxsize=2) for n in range(slices)]
+        stop = threading.Event()
+        try:
+            with ThreadPoolExecutor(max_workers=slices) as executor:
+                for low, high, pages in zip(bounds[:-1], bounds[1:], range_pages):
+                    key_range = {}
+                    if low is not None:
+                        key_range["gte"] = low
+                    if high is not None:
+                        key_range["lt"] = high
+                    filters = [{"range": {sort_field: key_range}}] if key_range else []
+                    if query is not None:
+                        filters.append(query)
+                    sort = [{sort_field: "asc"}, {"_shard_doc": "asc"}]
+                    body = self._search_body(pit_id, sort, {"bool": {"filter": filters}}, source, pagesize, keep_alive)
+                    executor.submit(self._read_pages, body, pages, stop, keep_alive)
+                try:
+                    for pages in range_pages:
+                        yield from self._yield_pages(pages)
+                finally:
+                    stop.set()
+        finally:
+            se.es.close_point_in_time(body={"id": pit_id})
+
+class FileManager():
+    """ A manager class for set-based queries against File objects and the file-list data that references them.
+
+    Usage::
+
+        manager = FileManager()
+        for fileid, path, tileid in manager.iterate_orphan_files():
+            ...
+    """
+
+    ## the file ids referenced by every file-list node value in every tile,
+    ## with each node's value expanded into its array elements, including
+    ## the values in pending provisional edits (`{userid: {"value": {...}}}`)
+    referenced_files_sql = """
+        SELECT f.value ->> 'file_id' AS fileid
+        FROM nodes n
+        JOIN tiles t ON t.nodegroupid = n.nodegroupid
+        CROSS JOIN LATERAL jsonb_array_elements(t.tiledata -> n.nodeid::text) AS f
+        WHERE n.datatype = 'file-list'
+        AND jsonb_typeof(t.tiledata -> n.nodeid::text) = 'array'
+        UNION ALL
+        SELECT f.value ->> 'file_id' AS fileid
+        FROM nodes n
+        JOIN tiles t ON t.nodegroupid = n.nodegroupid
+        CROSS JOIN LATERAL jsonb_each(t.provisionaledits) AS e
+        CROSS JOIN LATERAL jsonb_array_elements(e.value -> 'value' -> n.nodeid::text) AS f
+        WHERE n.datatype = 'file-list'
+        AND jsonb_typeof(t.provisionaledits) = 'object'
+        AND jsonb_typeof(e.value -> 'value' -> n.nodeid::text) = 'array'
+    """
+
+    def iterate_orphan_files(self, files=None, chunk_size=5000):
+        """
+        Yields `(fileid, path, tileid)` for each File object that isn't
+        referenced in any tile's file-list data, or in a pending provisional
+        edit (limited to those in the `files` queryset, if given), ordered by
+        fileid. This runs as a single anti-join, read through a server-side
+        cursor.
+        """
+
+        where, params = "", []
+        if files is not None:
+            scope_sql, params = files.order_by().values("fileid").query.sql_with_params()
+            where = f"AND fl.fileid IN ({scope_sql})"
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT fl.fileid::text, fl.path, fl.tileid::text
+                FROM files fl
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM ({self.referenced_files_sql}) AS r WHERE r.fileid = fl.fileid::text
+                )
+                {where}
+                ORDER BY fl.fileid
+            """, params)
+            while rows := cursor.fetchmany(chunk_size):
+                yield from rows
+
+    def iterate_file_references(self, resources=None, chunk_size=5000):
+        """
+        Yields `(resourceinstanceid, createdtime, fileid, name, path)` for
+        every file referenced in a file-list node of the resources (all, or
+        those in the `resources` queryset), ordered by created time. `path`
+        is None if there is no File object for the reference. This runs as a
+        single query, read through a server-side cursor.
+        """
+
+        where, params = "", []
+        if resources is not None:
+            scope_sql, params = resources.order_by().values("resourceinstanceid").query.sql_with_params()
+            where = f"AND r.resourceinstanceid IN ({scope_sql})"
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT r.resourceinstanceid::text, r.createdtime, f.value ->> 'file_id', f.value ->> 'name', fl.path
+                FROM nodes n
+                JOIN tiles t ON t.nodegroupid = n.nodegroupid
+                JOIN resource_instances r ON r.resourceinstanceid = t.resourceinstanceid
+                CROSS JOIN LATERAL jsonb_array_elements(t.tiledata -> n.nodeid::text) AS f
+                LEFT JOIN files fl ON fl.fileid::text = f.value ->> 'file_id'
+                WHERE n.datatype = 'file-list'
+                AND jsonb_typeof(t.tiledata -> n.nodeid::text) = 'array'
+                {where}
+                ORDER BY r.createdtime, r.resourceinstanceid
+            """, params)
+            while rows := cursor.fetchmany(chunk_size):
+                yield from rows
+
+    def delete_files(self, fileids, batch_size=1000):
+        """
+        Deletes the given File objects, one transaction per batch. Arches
+        removes each file from storage as its File object is deleted.
+        Returns the number of File objects deleted.
+        """
+
+        deleted = 0
+        for batch in chunked(fileids, batch_size):
+            with transaction.atomic():
+                count, by_model = models.File.objects.filter(pk__in=batch).delete()
+                deleted += by_model.get(models.File._meta.label, 0)
+        return deleted
@@ -1,8 +1,24 @@
+import os
 import uuid
+import shutil
+import queue
 import textwrap
-from typing import Union
+import threading
+import traceback
+import multiprocessing
+import psycopg2
+from pathlib import Path
+from time import localtime
+from tempfile import SpooledTemporaryFile
+from itertools import islice
+from collections import deque
+from typing import Iterable, Union
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 from argparse import RawTextHelpFormatter
 
+from django.conf import settings
+from django.db import connection, connections
 from django.db.models.functions import Lower
 
 from arches.app.models.graph import Graph
@@ -111,6 +127,7 @@ def get_graph(name_or_uuid: Union[str, uuid.UUID]) -> Graph:
     graph = None
     try:
         uid = uuid.UUID(str(name_or_uuid))
+        graph = Graph.objects.filter(pk=uid, isresource=True).first()
     except ValueError:
         qs = Graph.objects.annotate(name_lower=Lower('name'))
         graphs = qs.filter(name_lower=str(name_or_uuid).lower(), isresource=True)
@@ -123,8 +140,8 @@ def get_graph(name_or_uuid: Union[str, uuid.UUID]) -> Graph:
                 msg += f"\n{n}. {g.name}, {g.uuid}"
                 lookup[n] = g
             choice = input(msg)
-            if choice in lookup:
-                graph = lookup[choice]
+            if choice.isdigit() and int(choice) in lookup:
+                graph = lookup[int(choice)]
 
     return graph
 
@@ -137,4 +154,395 @@ def user_confirms(message:str="Continue?", default:bool=True):
     elif response.startswith("y"):
         return True
     else:
-        return False
\ No newline at end of file
+        return False
+
+def get_db_connection():
+    """ Opens a new psycopg2 connection to the default database, separate from Django's own connections. """
+    db = settings.DATABASES["default"]
+    db_conn = "dbname = {} port = {} user = {} host = {} password = {}".format(
+        db["NAME"], db["PORT"], db["USER"], db["HOST"], db["PASSWORD"]
+    )
+    return psycopg2.connect(db_conn)
+
+def chunked(iterable: Iterable, size: int):
+    """ Yields lists of up to `size` items from any iterable, without reading it all into memory. """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def ordered_map(func, iterable: Iterable, workers: int = 4, ahead: int = None):
+    """
+    Like `map()`, but runs `func` in a pool of `workers` threads, reading at
+    most `ahead` items past the one being yielded (default twice the number
+    of workers). Yields `(item, result)` in the original order. `func`
+    should handle its own exceptions.
+    """
+    ahead = ahead or workers * 2
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= ahead:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+def scan_directory(root: Union[str, Path], workers: int = 1):
+    """
+    Walks the directory tree under `root` with `os.scandir` and returns a
+    dict of file name: list of paths. With `workers` > 1, the top-level
+    subdirectories are walked concurrently.
+    """
+
+    def walk(directory):
+        found = {}
+        stack = [directory]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        found.setdefault(entry.name, []).append(Path(entry.path))
+        return found
+
+    index, subdirectories = {}, []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file():
+                index.setdefault(entry.name, []).append(Path(entry.path))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for found in executor.map(walk, subdirectories):
+            for name, paths in found.items():
+                index.setdefault(name, []).extend(paths)
+    return index
+
+MISSING = object()
+
+def merge_sorted(left: Iterable, right: Iterable):
+    """
+    Merges two iterables of `(key, value)` pairs that are each sorted by a
+    unique key, reading both as streams. Yields `(key, left_value,
+    right_value)` for every key in either one, with `MISSING` in place of
+    the value on the side where the key is absent.
+    """
+    left, right = iter(left), iter(right)
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], l[1], MISSING
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], MISSING, r[1]
+            r = next(right, None)
+        else:
+            yield l[0], l[1], r[1]
+            l, r = next(left, None), next(right, None)
+
+def get_uuid_ranges(keys, count: int):
+    """
+    Splits the distinct uuids returned by `keys` (a queryset of one uuid
+    column, e.g. from `values_list()`) into `count` contiguous,
+    non-overlapping ranges of roughly equal size. Returns a list of
+    inclusive `(low, high, count)` tuples, with the bounds as strings.
+    """
+
+    keys_sql, keys_params = keys.order_by().distinct().query.sql_with_params()
+    with connection.cursor() as cursor:
+        ## there is no min()/max() aggregate for uuid, so compare as text
+        cursor.execute(f"""
+            SELECT min(k::text COLLATE "C"), max(k::text COLLATE "C"), count(*)
+            FROM (
+                SELECT k, ntile(%s) OVER (ORDER BY k) AS part
+                FROM ({keys_sql}) AS keys(k)
+            ) AS parts
+            GROUP BY part
+            ORDER BY part
+        """, [count, *keys_params])
+        return cursor.fetchall()
+
+def _run_worker(target, index, messages, stop_event, args):
+
+    try:
+        messages.put(("done", index, target(index, messages, stop_event, *args)))
+    except Exception:
+        messages.put(("error", index, traceback.format_exc()))
+    finally:
+        connections.close_all()
+
+def run_in_processes(target, args_list: Iterable, on_message):
+    """
+    Runs `target(index, messages, stop_event, *args)` in a forked process
+    for each tuple of `args` in `args_list`, each with its own database
+    connection. Workers report through `messages.put((status, index,
+    payload))`, and every message other than the final "done" (with the
+    return value of `target`) or "error" (with a traceback) is passed on to
+    `on_message(status, index, payload)`. Workers should check
+    `stop_event` between units of work, which is set as soon as one of them
+    fails, dies without reporting, or the run is interrupted. Returns a
+    dict of worker index ("main" for an interruption): error message.
+    """
+
+    ## each child process must open its own database connection
+    connections.close_all()
+    ctx = multiprocessing.get_context("fork")
+    messages = ctx.Queue()
+    stop_event = ctx.Event()
+    processes = [
+        ctx.Process(target=_run_worker, args=(target, n, messages, stop_event, tuple(args)))
+        for n, args in enumerate(args_list)
+    ]
+    for process in processes:
+        process.start()
+
+    finished, errors = set(), {}
+    try:
+        while len(finished) < len(processes):
+            try:
+                status, index, payload = messages.get(timeout=1)
+            except queue.Empty:
+                ## catch workers that died without reporting (e.g. killed by the OS)
+                for n, process in enumerate(processes):
+                    if n not in finished and not process.is_alive():
+                        finished.add(n)
+                        errors[n] = f"worker exited unexpectedly with code {process.exitcode}"
+                        stop_event.set()
+                continue
+            if status == "done":
+                finished.add(index)
+            elif status == "error":
+                finished.add(index)
+                errors[index] = payload
+                stop_event.set()
+            else:
+                on_message(status, index, payload)
+    except KeyboardInterrupt:
+        stop_event.set()
+        errors["main"] = "interrupted"
+    finally:
+        for process in processes:
+            process.join()
+    return errors
+
+_chunks_done = object()
+
+class ZipArchiveWriter():
+    """
+    Streams files from a Django storage backend into one or more zip
+    archives, without holding any large file in memory. Files are read in
+    chunks by a pool of `readers` threads, a few files ahead of a single
+    writer that adds them to the archive in order, so slow (e.g. remote)
+    storage reads overlap. The writer spools each file to a temporary file
+    (kept in memory up to `spool_size` bytes) before adding it, so a file
+    that fails partway through is left out entirely rather than leaving a
+    truncated entry. Each entry is written with ZIP64 extensions if it
+    needs them, and file types that are already compressed are stored as
+    they are. Names are made unique across the whole run.
+
+    If `max_size` (bytes) is given, a new volume (`<stem>__001.zip`,
+    `<stem>__002.zip`, ...) is started before a file that would take the
+    current one past it. Otherwise everything goes into `<stem>.zip`.
+
+    Usage::
+
+        with ZipArchiveWriter("photos", max_size=4 * 1024 ** 3) as writer:
+            for key, arcname, volume, size, error in writer.write(entries):
+                ...
+    """
+
+    stored_suffixes = {
+        ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".jp2",
+        ".mp3", ".m4a", ".aac", ".ogg", ".flac",
+        ".mp4", ".m4v", ".mov", ".avi", ".mkv", ".webm", ".wmv",
+        ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar",
+        ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".pdf",
+    }
+
+    def __init__(self, stem, max_size=None, readers=4, chunk_size=1024 * 1024, names=None,
+                 spool_size=16 * 1024 * 1024):
+        self.stem = str(stem)
+        self.max_size = max_size
+        self.readers = readers
+        self.chunk_size = chunk_size
+        self.spool_size = spool_size
+        self.volumes = []
+        ## names to avoid, e.g. those already used in earlier archives
+        self.names = set(names or [])
+        self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _open_volume(self):
+
+        self.close()
+        if self.max_size:
+            path = Path(f"{self.stem}__{len(self.volumes) + 1:03d}.zip")
+        else:
+            path = Path(f"{self.stem}.zip")
+        self._zip = ZipFile(path, "w", compression=ZIP_DEFLATED, allowZip64=True)
+        self.volumes.append(path)
+
+    def _unique_name(self, name):
+
+        path = Path(name)
+        unique, n = name, 1
+        while unique in self.names:
+            n += 1
+            unique = str(path.with_name(f"{path.stem} ({n}){path.suffix}"))
+        self.names.add(unique)
+        return unique
+
+    def _read(self, storage, name, chunks, stop):
+        """
+        Runs in a reader thread, putting each chunk of the file's content
+        into `chunks`, followed by `_chunks_done` (or the exception if the
+        file can't be read).
+        """
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            with storage.open(name, "rb") as f:
+                while chunk := f.read(self.chunk_size):
+                    if not put(chunk):
+                        return
+            put(_chunks_done)
+        except Exception as e:
+            put(e)
+
+    def _write_entry(self, key, arcname, chunks):
+
+        with SpooledTemporaryFile(max_size=self.spool_size) as spool:
+            size = 0
+            while (chunk := chunks.get()) is not _chunks_done:
+                if isinstance(chunk, Exception):
+                    return key, None, None, 0, f"read failed after {size} bytes: {chunk!r}"
+                spool.write(chunk)
+                size += len(chunk)
+            spool.seek(0)
+
+            current_size = self._zip.fp.tell() if self._zip is not None else 0
+            if self._zip is None or (self.max_size and current_size > 0 and current_size + size > self.max_size):
+                self._open_volume()
+
+            arcname = self._unique_name(arcname)
+            info = ZipInfo(arcname, date_time=localtime()[:6])
+            info.compress_type = ZIP_STORED if Path(arcname).suffix.lower() in self.stored_suffixes else ZIP_DEFLATED
+            ## the size tells zipfile whether this entry needs ZIP64
+            info.file_size = size
+            with self._zip.open(info, "w") as dest:
+                shutil.copyfileobj(spool, dest, self.chunk_size)
+        return key, arcname, self.volumes[-1], size, None
+
+    def write(self, entries):
+        """
+        Adds each `(key, arcname, storage, name)` entry to the archive and
+        yields `(key, arcname, volume, size, error)` for it, in order.
+        `arcname` is the unique name actually used, and `error` is None
+        unless the file couldn't be read, in which case nothing is written
+        for it and `arcname` and `volume` are None.
+        """
+
+        entries = iter(entries)
+        in_flight = deque()
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.readers) as executor:
+
+            def submit_next():
+                entry = next(entries, None)
+                if entry is None:
+                    return False
+                key, arcname, storage, name = entry
+                ## a few chunks per file is enough to keep the writer busy
+                chunks = queue.Queue(maxsize=4)
+                executor.submit(self._read, storage, name, chunks, stop)
+                in_flight.append((key, arcname, chunks))
+                return True
+
+            try:
+                while len(in_flight) < self.readers and submit_next():
+                    pass
+                while in_flight:
+                    key, arcname, chunks = in_flight.popleft()
+                    result = self._write_entry(key, arcname, chunks)
+                    submit_next()
+                    yield result
+            finally:
+                stop.set()
+
+class DirectoryArchiveWriter():
+    """
+    Copies files from a Django storage backend into a directory tree under
+    `root`, with the same `write()` interface as `ZipArchiveWriter`. Files
+    are copied in chunks by `readers` threads, each to a temporary
+    `.partial` name that is renamed once it is complete, so an interrupted
+    run never leaves a truncated file in place. Arcnames are used as given
+    (e.g. storage names, which are already unique), and an existing file
+    with the same name is replaced.
+    """
+
+    def __init__(self, root, readers=4, chunk_size=1024 * 1024):
+        self.root = Path(root)
+        self.readers = readers
+        self.chunk_size = chunk_size
+        self.volumes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _copy(self, entry):
+
+        key, arcname, storage, name = entry
+        target = Path(self.root, arcname)
+        partial = target.with_name(target.name + ".partial")
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            written = 0
+            with storage.open(name, "rb") as src, open(partial, "wb") as dest:
+                while chunk := src.read(self.chunk_size):
+                    dest.write(chunk)
+                    written += len(chunk)
+            os.replace(partial, target)
+            return written, None
+        except Exception as e:
+            if partial.exists():
+                partial.unlink()
+            return 0, repr(e)
+
+    def write(self, entries):
+        """
+        Copies each `(key, arcname, storage, name)` entry and yields `(key,
+        arcname, root, size, error)` for it, in order, like
+        `ZipArchiveWriter.write()`.
+        """
+
+        for (key, arcname, storage, name), (size, error) in ordered_map(self._copy, entries, workers=self.readers):
+            if error:
+                yield key, None, None, 0, error
+                continue
+            if not self.volumes:
+                self.volumes.append(self.root)
+            yield key, arcname, self.root, size, None